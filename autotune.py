@@ -0,0 +1,192 @@
+import copy
+import math
+import time
+import warnings
+from dataclasses import dataclass, field
+import numpy as np
+from particles import ParticleSystem, Engine, DipoleState, SYMPLECTIC_WEIGHTS, EPS
+from kernels import BACKENDS, get_kernels, numba
+
+# Шаг демонстрации, от него строятся кандидаты по умолчанию
+DEFAULT_DT = 0.0001
+DT_FACTORS = [0.5, 1, 2, 4, 8, 16]
+# Стороны клеток поиска столкновений в диаметрах молекулы
+CELL_FACTORS = [1.0, 1.5, 2.0]
+# Шаги перед замером (компиляция Numba, прогрев кэшей) не учитываются
+WARMUP_STEPS = 5
+# За шаг быстрая молекула (квантиль SPEED_QUANTILE распределения скоростей, в процентах) должна
+# проходить не больше MAX_TRAVEL своих диаметров, иначе молекулы проскакивают друг сквозь друга.
+# Квантиль, а не наибольшая скорость: хвост распределения Максвелла растёт с числом молекул
+SPEED_QUANTILE = 99
+MAX_TRAVEL = 1.0
+# Ошибка энергии измеряется с SNAPSHOTS состояний эталонного прогона на самом мелком шаге
+SNAPSHOTS = 4
+
+
+@dataclass
+class Trial:
+    dt: float
+    cell_size: float
+    backend: str
+    steps: int
+    # Время одного шага, с
+    step_time: float
+    # Относительная ошибка энергии за калибровочный промежуток
+    error: float
+    # Путь быстрой молекулы (квантиль SPEED_QUANTILE) за шаг в диаметрах молекулы
+    travel: float
+
+    @property
+    def throughput(self):
+        # Модельное время за секунду счёта
+        return self.dt / max(self.step_time, EPS)
+
+    def is_accurate(self, tolerance, floor=0.0):
+        # floor - ошибка на самом мелком шаге. Шагу вменяется только превышение над ней: в схеме RK4
+        # подшаги диполей выбираются по их собственной скорости (get_substeps), и ошибка почти не зависит от dt
+        return self.error - floor <= tolerance and self.travel <= MAX_TRAVEL
+
+
+@dataclass
+class Tuning:
+    dt: float
+    cell_size: float
+    backend: str
+    trials: list = field(default_factory=list)
+
+    def apply(self, system):
+        # Переносит найденные ядра и клетку в существующую систему (dt передаётся в proceed)
+        system.backend = self.backend
+        system.kernels = get_kernels(self.backend)
+        system.kernels.allocate(system.n_dipoles)
+        system.cell_size = self.cell_size
+        if system.events is not None:
+            # Очередь событий движка EVENT строит свою сетку клеток; события предсказываются заново
+            system.events.cell_size = system.get_cell_size()
+            system.events.resize(system.max_width, system.max_height)
+
+
+def is_clean(system, bonds):
+    # Шаг без слипшихся диполей и без изменения связей: поправка скоростей кластера как твёрдого
+    # тела к ошибке интегрирования не относится
+    return not np.any(system.d_state == DipoleState.STUCK.value) and np.array_equal(system.bonds, bonds)
+
+
+def get_snapshots(parameters, dt, duration, seed):
+    # SNAPSHOTS копий системы с равными промежутками эталонного прогона на шаге dt, без слипшихся
+    # диполей. Ошибка каждого шага измеряется с одних и тех же состояний: траектории с разными
+    # шагами быстро расходятся, и слипание диполей в одних прогонах и его отсутствие в других
+    # меняют ошибку сильнее, чем сам шаг
+    random_state = np.random.get_state()
+    np.random.seed(seed)
+    system = ParticleSystem(**parameters)
+    for _ in range(WARMUP_STEPS):
+        system.proceed(dt)
+    steps = max(math.ceil(duration / dt), SNAPSHOTS)
+    snapshots = []
+    for step in range(steps):
+        if len(snapshots) * steps <= step * SNAPSHOTS and is_clean(system, system.bonds):
+            snapshots.append(copy.deepcopy(system))
+        system.proceed(dt)
+    np.random.set_state(random_state)
+    return snapshots
+
+
+def measure_error(snapshots, dt, window, duration):
+    # Относительная ошибка энергии шага dt за время duration. С каждого состояния snapshots система
+    # идёт время window, пока шаги чистые (is_clean); энергия ударов молекул о заряды в ошибку
+    # не входит (impulse_energy). Симплектические схемы энергию не поправляют: ошибка - наибольшее
+    # отклонение полной энергии. Остальные схемы поправляют её каждый шаг: ошибка - сумма поправок,
+    # пересчитанная на duration
+    random_state = np.random.get_state()
+    error = 0.0
+    elapsed = 0.0
+    scale = 0.0
+    for snapshot in snapshots:
+        system = copy.deepcopy(snapshot)
+        symplectic = system.integrator in SYMPLECTIC_WEIGHTS
+        energy = system.get_full_energy()
+        drift = 0.0
+        scale += system.get_full_kinetic() + system.gas_energy
+        for _ in range(max(math.ceil(window / dt), 1)):
+            bonds = system.bonds
+            res = system.proceed(dt)
+            if not is_clean(system, bonds):
+                break
+            elapsed += dt
+            if symplectic:
+                drift += res[-1] - energy - system.impulse_energy
+                error = max(error, abs(drift))
+            else:
+                error += abs(system.energy_error)
+            energy = res[-1]
+    np.random.set_state(random_state)
+    if elapsed == 0:
+        return math.inf
+    if not symplectic:
+        error *= duration / elapsed
+    # Ошибка отнесена к средней кинетической энергии: полная энергия может быть близка к нулю
+    return error / max(scale / len(snapshots), EPS)
+
+
+def run_trial(parameters, dt, duration, seed, error):
+    # Прогон системы с параметрами parameters в течение duration модельного времени: время шага
+    # и путь быстрой молекулы за шаг. Начальное состояние одно и то же для всех прогонов,
+    # глобальный генератор не сбивается
+    random_state = np.random.get_state()
+    np.random.seed(seed)
+    system = ParticleSystem(**parameters)
+    np.random.set_state(random_state)
+    for _ in range(WARMUP_STEPS):
+        system.proceed(dt)
+    steps = max(math.ceil(duration / dt), 1)
+    speed = 0.0
+    elapsed = 0.0
+    for _ in range(steps):
+        start = time.perf_counter()
+        system.proceed(dt)
+        elapsed += time.perf_counter() - start
+        if system.count > 0 and system.engine != Engine.LANGEVIN:
+            speed += np.percentile(np.sqrt(np.sum(np.square(system.entities[:, 2:4], dtype=np.float64), axis=1)), SPEED_QUANTILE)
+    travel = speed / steps * dt / (2 * system.radius)
+    return Trial(dt, system.get_cell_size(), system.kernels.name, steps, elapsed / steps, error, travel)
+
+
+def autotune(parameters, dts=None, cell_sizes=None, backends=None, tolerance=1e-3, steps=200, seed=0):
+    # Подбор шага dt, клетки поиска столкновений и ядер для системы ParticleSystem(**parameters).
+    # Сначала на самом мелком шаге (steps шагов) сравниваются по скорости все пары (ядра, клетка),
+    # затем с лучшей парой каждый шаг из dts прогоняется на том же модельном времени.
+    # Выбирается шаг с наибольшим модельным временем за секунду счёта, у которого относительная
+    # ошибка энергии превышает ошибку самого мелкого шага не больше чем на tolerance,
+    # а быстрые молекулы за шаг проходят не больше MAX_TRAVEL диаметров.
+    # Ошибка от ядер и клетки не зависит, она измеряется для каждого шага один раз (measure_error).
+    if parameters.get('engine', Engine.STEP) == Engine.LANGEVIN:
+        raise ValueError("The Langevin engine does not conserve energy and cannot be auto-tuned")
+    dts = sorted(dts if dts is not None else [DEFAULT_DT * factor for factor in DT_FACTORS])
+    if cell_sizes is None:
+        cell_sizes = [2 * parameters['radius'] * factor for factor in CELL_FACTORS]
+    if backends is None:
+        backends = [name for name in BACKENDS if name != 'numba' or numba is not None]
+    duration = steps * dts[0]
+    snapshots = get_snapshots(parameters, dts[0], duration, seed)
+    errors = {dt: measure_error(snapshots, dt, dts[-1], duration) for dt in dts}
+    trials = []
+    for backend in backends:
+        for cell_size in cell_sizes:
+            trials.append(run_trial(dict(parameters, backend=backend, cell_size=cell_size), dts[0], duration, seed, errors[dts[0]]))
+    best = min(trials, key=lambda trial: trial.step_time)
+    for dt in dts[1:]:
+        trials.append(run_trial(dict(parameters, backend=best.backend, cell_size=best.cell_size), dt, duration, seed, errors[dt]))
+
+    if errors[dts[0]] > tolerance:
+        warnings.warn(f"The energy error at the finest time step {dts[0]} is {errors[dts[0]]:.3g}, above {tolerance}; "
+                      f"larger steps are judged by their excess over it")
+    candidates = [trial for trial in trials if trial.backend == best.backend and trial.cell_size == best.cell_size]
+    accurate = [trial for trial in candidates if trial.is_accurate(tolerance, errors[dts[0]])]
+    if accurate:
+        chosen = max(accurate, key=lambda trial: trial.throughput)
+    else:
+        # Ни один шаг не проходит проверку: самый мелкий из них - наименее рискованный
+        chosen = best
+        warnings.warn(f"No time step keeps the energy error within {tolerance} and the travel within {MAX_TRAVEL} diameters, using dt = {best.dt}")
+    return Tuning(chosen.dt, best.cell_size, best.backend, trials)
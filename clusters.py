@@ -0,0 +1,38 @@
+import numpy as np
+
+
+class DisjointSet:
+    # Система непересекающихся множеств: сжатие путей и объединение по рангу
+    def __init__(self, n):
+        self.parent = list(range(n))
+        self.rank = [0] * n
+
+    def find(self, a):
+        root = a
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[a] != root:
+            self.parent[a], a = root, self.parent[a]
+        return root
+
+    def union(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return
+        if self.rank[a] < self.rank[b]:
+            a, b = b, a
+        self.parent[b] = a
+        if self.rank[a] == self.rank[b]:
+            self.rank[a] += 1
+
+    def get_labels(self):
+        return np.array([self.find(i) for i in range(len(self.parent))], dtype=np.int64)
+
+
+def get_cluster_labels(n, first, second):
+    # Метка кластера для каждого из n элементов по списку связей (first[i], second[i])
+    clusters = DisjointSet(n)
+    for a, b in zip(first.tolist(), second.tolist()):
+        clusters.union(a, b)
+    return clusters.get_labels()
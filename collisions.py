@@ -0,0 +1,198 @@
+import numpy as np
+
+# Соседние клетки "полуоболочки": каждая пара клеток просматривается ровно один раз
+NEIGHBOUR_OFFSETS = [(0, 0), (1, 0), (-1, 1), (0, 1), (1, 1)]
+
+
+def get_min_image(diff, width, height):
+    # Разность координат в периодическом ящике приводится к ближайшему образу
+    diff = np.array(diff, dtype=float)
+    diff[..., 0] -= width * np.round(diff[..., 0] / width)
+    diff[..., 1] -= height * np.round(diff[..., 1] / height)
+    return diff
+
+
+def get_cell_keys(positions, cell_size, width, height):
+    nx = max(int(width // cell_size), 1)
+    ny = max(int(height // cell_size), 1)
+    cx = np.clip((positions[:, 0] // cell_size).astype(np.int64), 0, nx - 1)
+    cy = np.clip((positions[:, 1] // cell_size).astype(np.int64), 0, ny - 1)
+    return cx, cy, nx, ny
+
+
+def get_cell_pairs(positions, cell_size, width, height, max_dist=None, periodic=False):
+    # Кандидаты в пары (i < j) из одной или соседних клеток равномерной сетки.
+    # Если задан max_dist, остаются только пары ближе max_dist.
+    # В периодическом ящике соседи берутся через границу, расстояния - до ближайшего образа.
+    n = positions.shape[0]
+    if n < 2:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+    cx, cy, nx, ny = get_cell_keys(positions, cell_size, width, height)
+    keys = cy * nx + cx
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    index = np.arange(n)
+
+    firsts = []
+    seconds = []
+    for dx, dy in NEIGHBOUR_OFFSETS:
+        ncx = cx + dx
+        ncy = cy + dy
+        if periodic:
+            ncx %= nx
+            ncy %= ny
+        valid = (ncx >= 0) & (ncx < nx) & (ncy >= 0) & (ncy < ny)
+        # Поиск идёт в порядке возрастания ключей: обращения к sorted_keys почти последовательны
+        nkeys = (ncy * nx + ncx)[order]
+        start = np.empty(n, dtype=np.int64)
+        end = np.empty(n, dtype=np.int64)
+        start[order] = np.searchsorted(sorted_keys, nkeys, side='left')
+        end[order] = np.searchsorted(sorted_keys, nkeys, side='right')
+        counts = np.where(valid, end - start, 0)
+        total = counts.sum()
+        if total == 0:
+            continue
+        first = np.repeat(index, counts)
+        shifts = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        second = order[np.repeat(start, counts) + shifts]
+        if dx == 0 and dy == 0:
+            keep = first < second
+            first = first[keep]
+            second = second[keep]
+        firsts.append(first)
+        seconds.append(second)
+
+    if len(firsts) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+    first = np.concatenate(firsts)
+    second = np.concatenate(seconds)
+    first, second = np.minimum(first, second), np.maximum(first, second)
+    if periodic:
+        # При числе клеток меньше трёх соседи через границу совпадают, пары повторяются
+        keys = np.unique(first[first != second] * n + second[first != second])
+        first = keys // n
+        second = keys % n
+
+    if max_dist is not None:
+        diff = positions[second, 0:2] - positions[first, 0:2]
+        if periodic:
+            diff = get_min_image(diff, width, height)
+        close = diff[:, 0] ** 2 + diff[:, 1] ** 2 < max_dist ** 2
+        first = first[close]
+        second = second[close]
+
+    order = np.lexsort((second, first))
+    return first[order], second[order]
+
+
+def get_cross_pairs(points, queries, cell_size, width, height, max_dist, periodic=False):
+    # Пары (точка, запрос) ближе max_dist <= cell_size: запросы просматривают соседние клетки
+    # сетки, построенной только по points. Пары точек между собой не перебираются.
+    cx, cy, nx, ny = get_cell_keys(points, cell_size, width, height)
+    keys = cy * nx + cx
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    qx, qy, _, _ = get_cell_keys(queries, cell_size, width, height)
+    owners = np.arange(len(queries))
+    firsts = []
+    seconds = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            ncx = qx + dx
+            ncy = qy + dy
+            if periodic:
+                ncx %= nx
+                ncy %= ny
+            valid = (ncx >= 0) & (ncx < nx) & (ncy >= 0) & (ncy < ny)
+            nkeys = ncy * nx + ncx
+            start = np.searchsorted(sorted_keys, nkeys, side='left')
+            end = np.where(valid, np.searchsorted(sorted_keys, nkeys, side='right'), start)
+            counts = end - start
+            shifts = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            firsts.append(order[np.repeat(start, counts) + shifts])
+            seconds.append(np.repeat(owners, counts))
+    first = np.concatenate(firsts)
+    second = np.concatenate(seconds)
+    if periodic:
+        # При числе клеток меньше трёх одна клетка может попасть в соседи дважды
+        keys = np.unique(first * len(queries) + second)
+        first = keys // len(queries)
+        second = keys % len(queries)
+    diff = points[first, 0:2] - queries[second, 0:2]
+    if periodic:
+        diff = get_min_image(diff, width, height)
+    close = diff[:, 0] ** 2 + diff[:, 1] ** 2 < max_dist ** 2
+    return first[close], second[close]
+
+
+def get_conflict_free_batches(first, second, n):
+    # Разбивает пары на партии, в которых каждая частица встречается не более одного раза.
+    # В партию попадает пара, у которой наименьший номер среди всех пар обеих её частиц,
+    # поэтому каждая итерация забирает хотя бы одну пару.
+    remaining = np.arange(len(first))
+    batches = []
+    while len(remaining) > 0:
+        ids = np.arange(len(remaining))
+        best = np.full(n, len(remaining))
+        np.minimum.at(best, first[remaining], ids)
+        np.minimum.at(best, second[remaining], ids)
+        chosen = (best[first[remaining]] == ids) & (best[second[remaining]] == ids)
+        batches.append(remaining[chosen])
+        remaining = remaining[~chosen]
+    return batches
+
+
+def get_pair_order(entities, first, second, box=None):
+    # Пары по возрастанию расстояния (при равенстве - по номерам частиц)
+    diff = entities[second, 0:2] - entities[first, 0:2]
+    if box is not None:
+        diff = get_min_image(diff, *box)
+    order = np.lexsort((second, first, diff[:, 0] ** 2 + diff[:, 1] ** 2))
+    return first[order], second[order]
+
+
+def resolve_pairs(entities, first, second, box=None):
+    # Упругие столкновения одинаковых частиц для всех контактных пар.
+    # Пары обрабатываются от самых глубоких перекрытий к самым мелким, так что
+    # результат не зависит от порядка частиц в массиве.
+    # box = (width, height) - периодический ящик, расстояния до ближайшего образа.
+    if len(first) == 0:
+        return
+    first, second = get_pair_order(entities, first, second, box)
+    for batch in get_conflict_free_batches(first, second, entities.shape[0]):
+        i = first[batch]
+        j = second[batch]
+        r_diff = entities[j, 0:2] - entities[i, 0:2]
+        if box is not None:
+            r_diff = get_min_image(r_diff, *box)
+        r_mag2 = r_diff[:, 0] ** 2 + r_diff[:, 1] ** 2
+        dot = np.sum((entities[j, 2:4] - entities[i, 2:4]) * r_diff, axis=1)
+        mask = dot < 0
+        temp = r_diff[mask] * (dot[mask] / r_mag2[mask])[:, np.newaxis]
+        entities[j[mask], 2:4] -= temp
+        entities[i[mask], 2:4] += temp
+
+
+def spread_bits(values):
+    # Раздвигает биты 32-битных целых: b31..b0 -> 0 b31 0 b30 ... 0 b0
+    values = values.astype(np.int64) & 0xFFFFFFFF
+    values = (values | (values << 16)) & 0x0000FFFF0000FFFF
+    values = (values | (values << 8)) & 0x00FF00FF00FF00FF
+    values = (values | (values << 4)) & 0x0F0F0F0F0F0F0F0F
+    values = (values | (values << 2)) & 0x3333333333333333
+    values = (values | (values << 1)) & 0x5555555555555555
+    return values
+
+
+def get_morton_codes(ix, iy):
+    # Номер клетки вдоль кривой Мортона (Z-кривой)
+    return spread_bits(ix) | (spread_bits(iy) << 1)
+
+
+def get_morton_order(positions, cell_size, width, height):
+    # Перестановка точек вдоль кривой Мортона по клеткам сетки:
+    # близкие в пространстве точки оказываются рядом и в памяти
+    cx, cy, _, _ = get_cell_keys(positions, cell_size, width, height)
+    return np.argsort(get_morton_codes(cx, cy), kind='stable')
@@ -0,0 +1,226 @@
+import math
+import copy
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from collisions import get_cell_pairs
+from particles import Engine, get_gas_energy
+
+# Запас мест в каждой полосе и в ящиках для переходящих молекул (в долях от среднего числа молекул в полосе)
+SLAB_RESERVE = 1.0
+OUTBOX_RESERVE = 0.25
+
+
+def create_shared(shape, dtype):
+    size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+    memory = shared_memory.SharedMemory(create=True, size=size)
+    array = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+    array[...] = 0
+    return memory, array
+
+
+def attach_shared(name, shape, dtype):
+    memory = shared_memory.SharedMemory(name=name)
+    return memory, np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+
+
+class DecomposedSystem:
+    # Газ системы делится на вертикальные полосы, каждую ведёт свой процесс. Молекулы полосы лежат
+    # в разделяемой памяти (blocks[k][:counts[k]]), так что соседние процессы читают и меняют граничные
+    # (теневые) молекулы друг друга на месте, а перешедшие через границу молекулы передаются
+    # через ящики outboxes. Диполи интегрирует главный процесс: перед шагом их состояние
+    # раздаётся всем полосам, после шага толчки от ударов всех полос складываются.
+    # Поддерживается движок STEP в ящике со стенками, без заряженного газа.
+    def __init__(self, system, workers=None):
+        if system.engine != Engine.STEP or system.periodic or system.mesh is not None or system.swept:
+            raise ValueError("Decomposition supports the STEP engine in a walled box without a charged or swept gas")
+        workers = workers or multiprocessing.cpu_count()
+        if system.max_width / workers < 8 * system.radius:
+            raise ValueError(f"Slabs of {system.max_width / workers} are too narrow for particles of radius {system.radius}")
+        self.system = system
+        self.workers = workers
+        self.bounds = np.linspace(0, system.max_width, workers + 1)
+        self.bounds[-1] = np.inf
+        self.bounds[0] = -np.inf
+        n = system.n_dipoles
+        count = len(system.entities)
+        self.capacity = int(count / workers * (1 + SLAB_RESERVE)) + 1024
+        self.box = int(count / workers * OUTBOX_RESERVE) + 256
+        self.layout = {
+            'blocks': ((workers, self.capacity, 4), system.dtype),
+            'ids': ((workers, self.capacity), np.int64),
+            'counts': ((workers,), np.int64),
+            'outboxes': ((workers, 2, self.box, 4), system.dtype),
+            'outbox_ids': ((workers, 2, self.box), np.int64),
+            'outbox_counts': ((workers, 2), np.int64),
+            'state': ((6 * n,), np.float64),
+            'results': ((workers, 3 * n + 1), np.float64),
+        }
+        self.memory = {}
+        self.arrays = {}
+        for key, (shape, dtype) in self.layout.items():
+            self.memory[key], self.arrays[key] = create_shared(shape, dtype)
+
+        slab = np.searchsorted(self.bounds, system.entities[:, 0], side='right') - 1
+        for k in range(workers):
+            rows = np.flatnonzero(slab == k)
+            if len(rows) > self.capacity:
+                raise ValueError("Particles are too unevenly spread over the slabs")
+            self.arrays['blocks'][k, :len(rows)] = system.entities[rows]
+            self.arrays['ids'][k, :len(rows)] = system.ids[rows]
+            self.arrays['counts'][k] = len(rows)
+        # Газ теперь хранится в полосах; у главной системы остаются число молекул и энергия
+        system.entities = system.buffer[:0]
+        system.ids = system.ids[:0]
+        self.coef = 1.0
+
+        context = multiprocessing.get_context()
+        barrier = context.Barrier(workers)
+        names = {key: (memory.name,) + self.layout[key] for key, memory in self.memory.items()}
+        self.pipes = []
+        self.processes = []
+        for k in range(workers):
+            parent, child = context.Pipe()
+            process = context.Process(target=run_slab, args=(k, self.bounds, names, copy.deepcopy(system), barrier, child), daemon=True)
+            process.start()
+            self.pipes.append(parent)
+            self.processes.append(process)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def proceed(self, dt):
+        system = self.system
+        if system.prev_charge != system.charge or system.prev_m != system.m or system.prev_charge_mass != system.charge_mass:
+            raise ValueError("Parameters of a decomposed system cannot change during the run")
+        forced = system.begin_step()
+        system.reflect_dipoles()
+        self.arrays['state'][:] = system.state
+        for pipe in self.pipes:
+            pipe.send((dt, self.coef))
+        errors = [error for error in (pipe.recv() for pipe in self.pipes) if error is not None]
+        if errors:
+            raise RuntimeError("; ".join(errors))
+        n = system.n_dipoles
+        results = self.arrays['results'].sum(axis=0)
+        system.dv += results[0:2 * n].reshape(n, 2)
+        system.dw += results[2 * n:3 * n]
+        # Энергия газа - сумма пересчётов по полосам (в float64 при любом хранении молекул)
+        system.gas_energy = results[3 * n]
+        energy = system.gas_energy
+        result = system.end_step(dt, forced, recount=False)
+        # Перемасштабирование скоростей газа откладывается до следующего шага полос
+        self.coef = math.sqrt(system.gas_energy / energy) if energy > 0 else 1.0
+        return result
+
+    def get_entities(self):
+        # Весь газ в порядке исходных номеров молекул: (N, 4)
+        counts = self.arrays['counts']
+        blocks = [self.arrays['blocks'][k, :counts[k]] for k in range(self.workers)]
+        ids = np.concatenate([self.arrays['ids'][k, :counts[k]] for k in range(self.workers)])
+        entities = np.concatenate(blocks)[np.argsort(ids)]
+        entities[:, 2:4] *= self.coef
+        return entities
+
+    def close(self):
+        for pipe in self.pipes:
+            try:
+                pipe.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self.processes:
+            process.join(timeout=5)
+        self.pipes = []
+        self.processes = []
+        for memory in self.memory.values():
+            memory.close()
+            memory.unlink()
+        self.memory = {}
+
+
+def run_slab(k, bounds, names, system, barrier, pipe):
+    memory = {}
+    arrays = {}
+    for key, (name, shape, dtype) in names.items():
+        memory[key], arrays[key] = attach_shared(name, shape, dtype)
+    blocks = arrays['blocks']
+    ids = arrays['ids']
+    counts = arrays['counts']
+    workers = len(counts)
+    n = system.n_dipoles
+    low = bounds[k]
+    high = bounds[k + 1]
+    reach = 2 * system.radius
+    while True:
+        task = pipe.recv()
+        if task is None:
+            break
+        dt, coef = task
+        try:
+            block = blocks[k, :counts[k]]
+            if coef != 1.0:
+                block[:, 2:4] *= coef
+            system.state[:] = arrays['state']
+            system.dv = np.zeros((n, 2))
+            system.dw = np.zeros(n)
+            system.entities = block
+            system.count = len(block)
+            system.kernels.advect(block, dt, system.max_width, system.max_height, False)
+            if system.obstacles is not None:
+                system.obstacles.reflect(block[:, 0:2], block[:, 2:4], system.radius)
+            system.collide_gas()
+            first, second = get_cell_pairs(block, system.get_cell_size(), system.max_width, system.max_height, max_dist=reach)
+            system.kernels.resolve_pairs(block, first, second, system.max_width, system.max_height, False)
+            barrier.wait()
+
+            # Пары через правую границу разрешает левая полоса; граничные слои разных границ
+            # не пересекаются, пока полоса шире 4 радиусов плюс смещение за шаг
+            if k + 1 < workers:
+                other = blocks[k + 1, :counts[k + 1]]
+                mine = np.flatnonzero(block[:, 0] > high - reach)
+                theirs = np.flatnonzero(other[:, 0] < high + reach)
+                joined = np.concatenate((block[mine], other[theirs]))
+                first, second = get_cell_pairs(joined, reach, system.max_width, system.max_height, max_dist=reach)
+                cross = (first < len(mine)) & (second >= len(mine))
+                system.kernels.resolve_pairs(joined, first[cross], second[cross], system.max_width, system.max_height, False)
+                block[mine, 2:4] = joined[:len(mine), 2:4]
+                other[theirs, 2:4] = joined[len(mine):, 2:4]
+            barrier.wait()
+
+            # Молекулы, покинувшие полосу, перекладываются в ящики для соседей
+            own = ids[k, :counts[k]]
+            for side, leaving in enumerate((block[:, 0] < low, block[:, 0] >= high)):
+                moved = np.flatnonzero(leaving)
+                if len(moved) > arrays['outboxes'].shape[2]:
+                    raise RuntimeError(f"Too many particles leave slab {k} in one step")
+                arrays['outboxes'][k, side, :len(moved)] = block[moved]
+                arrays['outbox_ids'][k, side, :len(moved)] = own[moved]
+                arrays['outbox_counts'][k, side] = len(moved)
+            stay = (block[:, 0] >= low) & (block[:, 0] < high)
+            size = np.count_nonzero(stay)
+            block[:size] = block[stay]
+            own[:size] = own[stay]
+            barrier.wait()
+            for neighbour, side in ((k - 1, 1), (k + 1, 0)):
+                if 0 <= neighbour < workers:
+                    moved = arrays['outbox_counts'][neighbour, side]
+                    if size + moved > blocks.shape[1]:
+                        raise RuntimeError(f"Slab {k} is full")
+                    blocks[k, size:size + moved] = arrays['outboxes'][neighbour, side, :moved]
+                    ids[k, size:size + moved] = arrays['outbox_ids'][neighbour, side, :moved]
+                    size += moved
+            counts[k] = size
+
+            results = arrays['results'][k]
+            results[0:2 * n] = system.dv.ravel()
+            results[2 * n:3 * n] = system.dw
+            results[3 * n] = get_gas_energy(blocks[k, :size, 2:4], system.m)
+            pipe.send(None)
+        except Exception as error:
+            barrier.abort()
+            pipe.send(f"Slab {k}: {error!r}")
+    for array in memory.values():
+        array.close()
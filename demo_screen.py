@@ -55,7 +55,7 @@ class DemoScreen():
         pygame.draw.rect(self.screen, Color.BLACK.rgb, Rectangle(0, 0, self.width * self.scale[0], self.height * self.scale[1]), 1)
 
         self.mode = NOT_STARTED
-        self.slider = Slider(self.screen, x=int(1600 * self.scale[0]), y=int(50 * self.scale[1]), width=int(250 * self.scale[0]), height=int(10 * self.scale[1]), min=0, max=800, initial=200, step=1)
+        self.slider = Slider(self.screen, x=int(1600 * self.scale[0]), y=int(50 * self.scale[1]), width=int(250 * self.scale[0]), height=int(10 * self.scale[1]), min=0, max=5000, initial=200, step=1)
         self.textbox = TextBox(self.screen, int(1700 * self.scale[0]), int(70 * self.scale[1]), int(60 * self.scale[0]), int(30 * self.scale[1]), fontSize=20)
         self.particles_number = 1000
         self.speed = 500
@@ -155,6 +155,17 @@ class DemoScreen():
         self.particle_system.charge = self.charge
         self.particle_system.charge_mass = self.charge_mass
         self.particle_system.m = self.m
+        if self.mode != NOT_STARTED:
+            # Число молекул и размеры ящика меняются на ходу, без пересоздания системы
+            try:
+                if self.particles_number > self.particle_system.count:
+                    self.particle_system.add_particles(self.particles_number - self.particle_system.count)
+                elif self.particles_number < self.particle_system.count:
+                    self.particle_system.remove_particles(self.particle_system.count - self.particles_number)
+            except ValueError:
+                self.slider.setValue(self.particle_system.count)
+            if self.width != self.particle_system.max_width or self.height != self.particle_system.max_height:
+                self.particle_system.resize(self.width, self.height)
 
     def _update_screen(self):
         self.screen.fill(self.bg_color)
@@ -221,11 +232,9 @@ class DemoScreen():
                             radius=int(self.particle_system.radius * self.scale[1]),
                             color=self.particle_color
                         )
-                for i in range(2):
-                    cos = math.cos(self.particle_system.dipoles[i].actangle)
-                    sin = math.sin(self.particle_system.dipoles[i].actangle)
-                    pos0 = self.particle_system.dipoles[i].pos + self.particle_system.r * np.array([cos, sin])
-                    pos1 = self.particle_system.dipoles[i].pos - self.particle_system.r * np.array([cos, sin])
+                charges = self.particle_system.get_charge_positions()
+                for i in range(self.particle_system.n_dipoles):
+                    pos0, pos1 = charges[i]
                     pygame_draw_filled_circle(
                         surface=self.screen,
                         pos=Position(
@@ -244,7 +253,7 @@ class DemoScreen():
                         radius=int(self.particle_system.d_radius * self.scale[1]),
                         color=Color.RED
                     )
-                    pygame.draw.line(self.screen, self.dipole_colors[i], (pos0[0] * self.scale[0], pos0[1] * self.scale[1]),
+                    pygame.draw.line(self.screen, self.dipole_colors[i % len(self.dipole_colors)], (pos0[0] * self.scale[0], pos0[1] * self.scale[1]),
                                     (pos1[0] * self.scale[0], pos1[1] * self.scale[1]), width=int(5 * self.scale[1]))
             except:
                 self.mode = NOT_STARTED    
@@ -281,11 +290,9 @@ class DemoScreen():
                         radius=int(self.particle_system.radius * self.scale[1]),
                         color=self.particle_color
                     )
-            for i in range(2):
-                cos = math.cos(self.particle_system.dipoles[i].actangle)
-                sin = math.sin(self.particle_system.dipoles[i].actangle)
-                pos0 = self.particle_system.dipoles[i].pos + self.particle_system.r * np.array([cos, sin])
-                pos1 = self.particle_system.dipoles[i].pos - self.particle_system.r * np.array([cos, sin])
+            charges = self.particle_system.get_charge_positions()
+            for i in range(self.particle_system.n_dipoles):
+                pos0, pos1 = charges[i]
                 pygame_draw_filled_circle(
                     surface=self.screen,
                     pos=Position(
@@ -304,7 +311,7 @@ class DemoScreen():
                     radius=int(self.particle_system.d_radius * self.scale[1]),
                     color=Color.RED
                 )
-                pygame.draw.line(self.screen, self.dipole_colors[i], (pos0[0] * self.scale[0], pos0[1] * self.scale[1]),
+                pygame.draw.line(self.screen, self.dipole_colors[i % len(self.dipole_colors)], (pos0[0] * self.scale[0], pos0[1] * self.scale[1]),
                                 (pos1[0] * self.scale[0], pos1[1] * self.scale[1]), width=int(5 * self.scale[1]))
         else:
             self.buttons = [Button(self.app, "Начать" if self.app.russian else "Start", (1000, 800), (250, 70), font_size=30),
@@ -337,6 +344,10 @@ class DemoScreen():
             self.slider_height.draw()
             self.slider_d_radius.draw()
             self.slider_r.draw()
+        else:
+            self.slider.draw()
+            self.slider_width.draw()
+            self.slider_height.draw()
         self.textbox.draw()
         self.textbox_s.draw()
         self.textbox_radius.draw()
@@ -362,9 +373,20 @@ class DemoScreen():
                     self.app.active_screen = self.app.menu_screen
                 elif button.msg == 'Начать' or button.msg == 'Start':
                     self.mode = ACTIVATED
-                    self.particle_system = ParticleSystem(self.particles_number, float(self.radius), max_width=self.width, max_height=self.height, 
-                                                          avg_vel=float(self.speed), d_radius=float(self.d_radius), r=self.r / 2, charge=float(self.charge), 
-                                                          charge_mass=float(self.charge_mass), m=float(self.m))
+                    # Если молекулы не помещаются в ящик без перекрытий, их число уменьшается вдвое,
+                    # пока не поместятся, и ползунок ставится на это число
+                    count = self.particles_number
+                    while True:
+                        try:
+                            self.particle_system = ParticleSystem(count, float(self.radius), max_width=self.width, max_height=self.height, 
+                                                                  avg_vel=float(self.speed), d_radius=float(self.d_radius), r=self.r / 2, charge=float(self.charge), 
+                                                                  charge_mass=float(self.charge_mass), m=float(self.m), capacity=self.slider.max)
+                            break
+                        except ValueError:
+                            count //= 2
+                    if count != self.particles_number:
+                        self.slider.setValue(count)
+                        self.particles_number = count
                     self.times = [0]
                     self.data = [[0], [0], [0], [0]]
                     self.has_data = False
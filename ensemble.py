@@ -0,0 +1,216 @@
+import numpy as np
+from collisions import get_cell_pairs, get_cross_pairs
+from particles import (ParticleSystem, Engine, Integrator, DipoleState, MIN_DIST, cross, get_kinetic, get_charge_positions,
+                       get_charge_velocities, get_charge_forces, get_dipole_potential, runge_knuta_4, get_substeps, get_clusters,
+                       get_state_views, get_sticking, update_clusters, reflect_walls, hit_charges, finish_step)
+
+
+class Ensemble:
+    # B независимых копий (реплик) системы с одинаковыми параметрами, которые продвигаются
+    # одним вызовом: газ - массив (B, N, 4), состояние диполей - (B, 6M). Все операции шага идут
+    # сразу по всем репликам: реплики ставятся на общей сетке клеток рядом вдоль x с зазором,
+    # так что пары из разных реплик не находятся, а номера диполей и кластеров - сквозные (b * M + k).
+    # Каждая реплика проходит тот же шаг, что и ParticleSystem.proceed.
+    # Поддерживается движок STEP с интегратором RK4 в ящике со стенками, без заряженного газа,
+    # препятствий и поиска ударов по путям.
+    def __init__(self, replicas, **parameters):
+        systems = [ParticleSystem(**parameters) for _ in range(replicas)]
+        system = systems[0]
+        if system.engine != Engine.STEP or system.integrator != Integrator.RK4:
+            raise ValueError("Ensemble supports the STEP engine with the RK4 integrator")
+        if system.periodic or system.mesh is not None or system.obstacles is not None or system.swept:
+            raise ValueError("Ensemble supports a walled box without a charged gas, obstacles or swept collisions")
+        # Параметры берутся из первой реплики, они общие для всех
+        self.system = system
+        self.replicas = replicas
+        n = system.n_dipoles
+        # Газ всех реплик - один C-массив, чтобы reshape(-1, 4) был представлением, а не копией
+        self.entities = np.array(np.stack([item.entities for item in systems]), dtype=system.dtype, order='C')
+        self.state = np.stack([item.state for item in systems])
+        self.d_pos, self.d_angle, self.d_vel, self.d_w = get_state_views(self.state)
+        self.stages = np.zeros((4, replicas, 6 * n))
+        self.stage_state = np.zeros((replicas, 6 * n))
+        self.d_state = np.full((replicas, n), DipoleState.NORMAL.value)
+        self.bonds = np.empty((0, 2), dtype=np.int64)
+        self.cluster = np.arange(replicas * n)
+        self.full = np.array([item.full for item in systems])
+        self.gas_energy = np.array([item.gas_energy for item in systems], dtype=np.float64)
+        self.full_p = self.gas_energy.copy()
+        self.dv = np.zeros((replicas, n, 2))
+        self.dw = np.zeros((replicas, n))
+        # Ошибка интегрирования последнего шага и энергия ударов за шаг, по репликам (см. ParticleSystem)
+        self.energy_error = np.zeros(replicas)
+        self.impulse_energy = np.zeros(replicas)
+
+    def get_full_particles_energy(self):
+        # Кинетическая энергия газа каждой реплики: (B,)
+        return self.system.m * np.sum(np.square(self.entities[:, :, 2:4], dtype=np.float64), axis=(1, 2)) / 2
+
+    def get_charge_positions(self):
+        return get_charge_positions(self.d_pos, self.d_angle, self.system.r)
+
+    def get_offset(self, cell_size):
+        # Сдвиг реплик по x на общей сетке: между репликами остаются пустые клетки,
+        # даже если центры диполей выходят за стенку на плечо r
+        return self.system.max_width + 2 * self.system.r + 3 * cell_size
+
+    def shift(self, points, cell_size):
+        # (B, P, 2) -> (B * P, 2): точки реплики b сдвинуты на b * offset
+        shifted = np.array(points[..., 0:2], dtype=np.float64)
+        shifted[..., 0] += self.get_offset(cell_size) * np.arange(self.replicas)[:, np.newaxis]
+        return shifted.reshape(-1, 2)
+
+    def get_pairs(self, points, cell_size):
+        # Кандидаты в пары (i < j) сквозных номеров точек из соседних клеток, только внутри реплик
+        return get_cell_pairs(self.shift(points, cell_size), cell_size, self.replicas * self.get_offset(cell_size), self.system.max_height)
+
+    def get_contacts(self, charges, reach):
+        # Пары (заряд, молекула) ближе reach в сквозных номерах, по зарядам, затем по молекулам.
+        # Расстояния проверяются по исходным координатам, как в ParticleSystem, а не по сдвинутым
+        cell_size = reach * (1 + 1e-9)
+        charges = charges.reshape(self.replicas, -1, 2)
+        index, owners = get_cross_pairs(self.shift(self.entities, cell_size), self.shift(charges, cell_size), cell_size,
+                                        self.replicas * self.get_offset(cell_size), self.system.max_height, cell_size)
+        gas = self.entities.reshape(-1, 4)
+        diff = gas[index, 0:2] - charges.reshape(-1, 2)[owners]
+        close = np.sum(diff ** 2, axis=1) < reach ** 2
+        order = np.lexsort((index[close], owners[close]))
+        return owners[close][order], index[close][order]
+
+    def collide_gas(self):
+        # Удары молекул о заряды: заряды обходятся по порядку (как в ParticleSystem),
+        # каждый - сразу во всех репликах
+        system = self.system
+        n = system.n_dipoles
+        gas = self.entities.reshape(-1, 4)
+        charges = self.get_charge_positions()
+        velocities = get_charge_velocities(self.d_vel, self.d_angle, self.d_w, system.r)
+        owners, index = self.get_contacts(charges, system.radius + system.d_radius)
+        slot = owners % (2 * n)
+        for i in np.unique(slot):
+            group = slot == i
+            replica = owners[group] // (2 * n)
+            k = i // 2
+            pos = charges[:, k, i % 2]
+            j = index[group]
+            before = np.sum(np.square(gas[j, 2:4], dtype=np.float64), axis=1)
+            _, dv, dw = hit_charges(gas, j, replica, pos, pos - self.d_pos[:, k], velocities[:, k, i % 2],
+                                    system.m, system.charge_mass, system.d_radius, system.r)
+            self.dv[:, k] += dv
+            self.dw[:, k] += dw
+            after = np.sum(np.square(gas[j, 2:4], dtype=np.float64), axis=1)
+            change = system.m * np.bincount(replica, weights=after - before, minlength=self.replicas) / 2
+            self.gas_energy += change
+            self.impulse_energy += change
+
+    def resolve_gas(self):
+        # Столкновения молекул между собой во всех репликах одним набором пар
+        radius = self.system.radius
+        gas = self.entities.reshape(-1, 4)
+        first, second = self.get_pairs(self.entities, self.system.get_cell_size())
+        diff = gas[second, 0:2] - gas[first, 0:2]
+        close = diff[:, 0] ** 2 + diff[:, 1] ** 2 < (2 * radius) ** 2
+        self.system.kernels.resolve_pairs(gas, first[close], second[close], self.system.max_width, self.system.max_height, False)
+
+    def reflect_dipoles(self):
+        system = self.system
+        reflect_walls(self.state, self.cluster, system.r, system.max_width, system.max_height)
+
+    def update_sticking(self):
+        # Связи между диполями по тем же правилам, что и в ParticleSystem.update_sticking
+        system = self.system
+        charges = self.get_charge_positions().reshape(-1, 2, 2)
+        first, second = self.get_pairs(self.d_pos, 2 * system.r + MIN_DIST)
+        self.bonds, self.cluster[:], stuck = get_sticking(charges, first, second, self.bonds)
+        self.d_state[:] = np.where(stuck, DipoleState.STUCK.value, DipoleState.NORMAL.value).reshape(self.d_state.shape)
+
+    def derivatives(self, y, out):
+        # Правая часть уравнений движения для состояний всех реплик (B, 6M)
+        system = self.system
+        n = system.n_dipoles
+        pos = y[:, 0:2 * n].reshape(-1, n, 2)
+        angle = y[:, 2 * n:3 * n]
+        arm = system.r * np.stack((np.cos(angle), np.sin(angle)), axis=-1)
+        charges = np.stack((pos + arm, pos - arm), axis=-2)
+        forces = get_charge_forces(charges, system.charge, system.r)
+        out[:, 0:3 * n] = y[:, 3 * n:6 * n]
+        out[:, 3 * n:5 * n] = ((forces[:, :, 0] + forces[:, :, 1]) / (2 * system.charge_mass)).reshape(-1, 2 * n)
+        inertial = system.charge_mass * ((4 * (system.d_radius ** 2) / 5) + (2 * (system.r ** 2)))
+        out[:, 5 * n:6 * n] = cross(arm, forces[:, :, 0] - forces[:, :, 1]) / inertial
+        return out
+
+    def runge_knuta_4(self, dt):
+        runge_knuta_4(self.derivatives, self.state, self.stages, self.stage_state, dt)
+
+    def get_clusters(self):
+        return get_clusters(self.cluster)
+
+    def update_dipoles(self, dt, forced=False):
+        # Слипшиеся диполи движутся как твёрдые тела (см. ParticleSystem.update_dipoles)
+        system = self.system
+        if not forced:
+            self.update_sticking()
+        stuck, body = self.get_clusters()
+        if len(stuck) == 0:
+            self.runge_knuta_4(dt)
+            return
+        rates = self.derivatives(self.state, self.stages[0])
+        mass = 2 * system.charge_mass
+        inertial = system.charge_mass * ((4 * (system.d_radius ** 2) / 5) + (2 * (system.r ** 2)))
+        update_clusters(self.state, rates, stuck, body, self.runge_knuta_4, dt, mass, inertial)
+
+    def get_substeps(self, dt):
+        # Число подшагов общее для всех реплик - по самой быстрой из них
+        system = self.system
+        if system.substeps > 0:
+            return system.substeps
+        return get_substeps(self.state, self.derivatives(self.state, self.stages[0]), system.r, dt)
+
+    def get_kinetics(self):
+        system = self.system
+        return get_kinetic(self.d_vel, self.d_w, mass=system.charge_mass, d_radius=system.d_radius, r=system.r)
+
+    def get_full_potential(self):
+        system = self.system
+        return get_dipole_potential(self.d_pos, self.d_angle, system.r, system.charge, system.r)
+
+    def reset_energy(self):
+        # Текущая энергия каждой реплики становится опорной для перемасштабирования скоростей
+        self.full = self.get_full_potential() + np.sum(self.get_kinetics(), axis=-1)
+        self.gas_energy = self.get_full_particles_energy()
+        self.full_p = self.gas_energy.copy()
+
+    def begin_step(self):
+        # Начало шага, как в ParticleSystem.begin_step: обнуление ударов и учёт параметров,
+        # изменённых у первой реплики; возвращает forced для update_dipoles
+        system = self.system
+        self.dv[:] = 0
+        self.dw[:] = 0
+        self.impulse_energy[:] = 0
+        forced = False
+        if system.prev_charge != system.charge or system.prev_m != system.m or system.prev_charge_mass != system.charge_mass:
+            self.reset_energy()
+            system.prev_charge = system.charge
+            system.prev_charge_mass = system.charge_mass
+            system.prev_m = system.m
+        if system.charge == 0:
+            self.bonds = np.empty((0, 2), dtype=np.int64)
+            self.cluster[:] = np.arange(len(self.cluster))
+            self.d_state[:] = DipoleState.NORMAL.value
+            forced = True
+        return forced
+
+    def proceed(self, dt):
+        # Шаг всех реплик; результат - (B, M + 2): энергии диполей, потенциальная и полная энергия
+        system = self.system
+        gas = self.entities.shape[1] > 0
+        forced = self.begin_step()
+        if gas:
+            system.kernels.advect(self.entities.reshape(-1, 4), dt, system.max_width, system.max_height, False)
+        self.reflect_dipoles()
+        if gas:
+            self.collide_gas()
+            self.resolve_gas()
+
+        kinetics, potential, _ = finish_step(self, dt, forced, gas, system.charge > 0 or gas)
+        return np.column_stack((kinetics, potential, potential + np.sum(kinetics, axis=-1) + self.gas_energy))
@@ -0,0 +1,337 @@
+import heapq
+import math
+import numpy as np
+from collisions import get_min_image, get_cell_keys, get_cell_pairs
+
+X_WALL = -1
+Y_WALL = -2
+# Пересчёт события частицы в периодическом ящике меньше трёх клеток (см. EventQueue.resize)
+CHECK = -3
+# Переход частицы в соседнюю клетку сетки по x или по y
+X_CELL = -4
+Y_CELL = -5
+
+
+class EventQueue:
+    # Событийная динамика твёрдых дисков: очередь предсказанных столкновений
+    # частица-частица и частица-стенка. Положение частицы i в entities
+    # соответствует моменту stamps[i], скорости между событиями не меняются.
+    # Для каждой частицы в очереди хранится только её ближайшее событие.
+    # Столкновения ищутся только с частицами из соседних клеток сетки collisions.get_cell_keys
+    # (сторона клетки не меньше диаметра), поэтому переход в другую клетку - тоже событие.
+    def __init__(self, entities, radius, width, height, time=0.0, periodic=False, cell_size=None):
+        self.entities = entities
+        self.radius = radius
+        self.periodic = periodic
+        self.cell_size = max(cell_size or 0, 2 * radius)
+        self.time = time
+        self.resize(width, height)
+
+    def resize(self, width, height):
+        # Новая сетка клеток под ящик width x height; события предсказываются заново
+        self.width = width
+        self.height = height
+        self.nx = max(int(width // self.cell_size), 1)
+        self.ny = max(int(height // self.cell_size), 1)
+        # Границы клеток; последняя клетка доходит до стенки
+        self.x_bounds = np.append(np.arange(self.nx) * self.cell_size, width)
+        self.y_bounds = np.append(np.arange(self.ny) * self.cell_size, height)
+        self.neighbours = []
+        for key in range(self.nx * self.ny):
+            cx, cy = key % self.nx, key // self.nx
+            xs = {(cx + dx) % self.nx for dx in (-1, 0, 1)} if self.periodic else {x for x in (cx - 1, cx, cx + 1) if 0 <= x < self.nx}
+            ys = {(cy + dy) % self.ny for dy in (-1, 0, 1)} if self.periodic else {y for y in (cy - 1, cy, cy + 1) if 0 <= y < self.ny}
+            self.neighbours.append([y * self.nx + x for y in ys for x in xs])
+        # При числе клеток меньше трёх соседи через границу - это весь ящик, и ближайший образ
+        # может смениться раньше любого перехода между клетками
+        self.checks = self.periodic and (self.nx < 3 or self.ny < 3)
+        self.reset()
+
+    def reset(self, time=None):
+        # Все события предсказываются заново одним проходом по парам из соседних клеток
+        if time is not None:
+            self.time = time
+        n = self.entities.shape[0]
+        self.stamps = np.full(n, self.time)
+        self.counts = np.zeros(n, dtype=np.int64)
+        self.partners = np.full(n, -1, dtype=np.int64)
+        self.processed = 0
+        self.set_cells(np.arange(n))
+
+        times, partners = self.get_boundary_times(np.arange(n))
+        first, second = get_cell_pairs(self.entities[:, 0:2], self.cell_size, self.width, self.height, periodic=self.periodic)
+        pair_times = self.get_pair_times(first, second)
+        hit = np.isfinite(pair_times)
+        owners = np.concatenate((first[hit], second[hit]))
+        others = np.concatenate((second[hit], first[hit]))
+        pair_times = np.tile(pair_times[hit], 2)
+        # Для каждой частицы - её самое раннее столкновение, если оно раньше выхода из клетки
+        order = np.lexsort((pair_times, owners))
+        owners = owners[order]
+        earliest = np.concatenate(([True], owners[1:] != owners[:-1])) if len(owners) > 0 else np.zeros(0, dtype=bool)
+        owners = owners[earliest]
+        others = others[order][earliest]
+        pair_times = pair_times[order][earliest]
+        sooner = pair_times < times[owners]
+        times[owners[sooner]] = pair_times[sooner]
+        partners[owners[sooner]] = others[sooner]
+
+        valid = np.isfinite(times)
+        self.heap = [(self.time + t, i, j, 0, 0) for t, i, j in zip(times[valid].tolist(), np.flatnonzero(valid).tolist(), partners[valid].tolist())]
+        heapq.heapify(self.heap)
+
+    def set_cells(self, indices):
+        # Клетки частиц indices - по их положениям на момент stamps
+        if len(indices) == len(self.entities):
+            self.cells = np.zeros(len(indices), dtype=np.int64)
+            self.members = [set() for _ in range(self.nx * self.ny)]
+        else:
+            for i in indices:
+                self.members[self.cells[i]].discard(i)
+        cx, cy, _, _ = get_cell_keys(self.entities[indices, 0:2], self.cell_size, self.width, self.height)
+        self.cells[indices] = cy * self.nx + cx
+        for i, key in zip(np.asarray(indices).tolist(), self.cells[indices].tolist()):
+            self.members[key].add(i)
+
+    def get_positions(self, indices, time):
+        return self.entities[indices, 0:2] + self.entities[indices, 2:4] * (time - self.stamps[indices])[:, np.newaxis]
+
+    def get_pair_times(self, first, second):
+        # Время до касания для пар (first, second) от момента time; inf - пара не сблизится
+        dr = self.get_positions(second, self.time) - self.get_positions(first, self.time)
+        if self.periodic:
+            dr = get_min_image(dr, self.width, self.height)
+        dv = self.entities[second, 2:4] - self.entities[first, 2:4]
+        b = dr[:, 0] * dv[:, 0] + dr[:, 1] * dv[:, 1]
+        dv2 = dv[:, 0] * dv[:, 0] + dv[:, 1] * dv[:, 1]
+        c = dr[:, 0] * dr[:, 0] + dr[:, 1] * dr[:, 1] - (2 * self.radius) ** 2
+        d = b * b - dv2 * c
+        ok = (b < 0) & (d >= 0)
+        times = np.full(b.shape, np.inf)
+        times[ok] = np.maximum((-b[ok] - np.sqrt(d[ok])) / dv2[ok], 0.0)
+        return times
+
+    def get_check_time(self):
+        # Ближайший образ верен, пока частицы не сместились друг относительно друга
+        # на половину ящика; к этому времени событие частицы пересчитывается
+        speed = np.sqrt(np.max(np.sum(self.entities[:, 2:4] ** 2, axis=1)))
+        return max(min(self.width, self.height) / 2 - 2 * self.radius, 0) / max(2 * speed, 1e-20)
+
+    def get_boundary_times(self, indices):
+        # Время до выхода частиц indices из своей клетки и вид события: стенка ящика,
+        # переход в соседнюю клетку или (в маленьком периодическом ящике) проверка
+        pos = self.get_positions(indices, self.time)
+        vel = self.entities[indices, 2:4]
+        cells = self.cells[indices]
+        times = []
+        kinds = []
+        for axis, bounds, cell, wall, cross in ((0, self.x_bounds, cells % self.nx, X_WALL, X_CELL),
+                                                 (1, self.y_bounds, cells // self.nx, Y_WALL, Y_CELL)):
+            v = vel[:, axis]
+            bound = np.where(v > 0, bounds[cell + 1], bounds[cell])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                time = np.where(v != 0, (bound - pos[:, axis]) / v, np.inf)
+            times.append(np.maximum(time, 0.0))
+            outer = np.where(v > 0, cell == len(bounds) - 2, cell == 0)
+            kinds.append(np.where(outer & (not self.periodic), wall, cross))
+        axis = np.argmin(times, axis=0)
+        rows = np.arange(len(indices))
+        times = np.stack(times)[axis, rows]
+        kinds = np.stack(kinds)[axis, rows]
+        if self.checks:
+            check = self.get_check_time()
+            kinds = np.where(times > check, CHECK, kinds)
+            times = np.minimum(times, check)
+        return times, kinds
+
+    def get_boundary_event(self, i, x, y, vx, vy):
+        # То же для одной частицы в точке (x, y) со скоростью (vx, vy)
+        event = (math.inf, CHECK)
+        for pos, v, bounds, cell, wall, cross in ((x, vx, self.x_bounds, self.cells[i] % self.nx, X_WALL, X_CELL),
+                                                  (y, vy, self.y_bounds, self.cells[i] // self.nx, Y_WALL, Y_CELL)):
+            if v == 0:
+                continue
+            outer = cell == len(bounds) - 2 if v > 0 else cell == 0
+            time = max((bounds[cell + 1 if v > 0 else cell] - pos) / v, 0.0)
+            if time < event[0]:
+                event = (time, wall if outer and not self.periodic else cross)
+        if self.checks:
+            event = min(event, (self.get_check_time(), CHECK))
+        return event
+
+    def predict(self, i):
+        # Событие одной частицы считается в скалярах: кандидатов из соседних клеток единицы,
+        # и на таких массивах накладные расходы NumPy больше самого счёта
+        x, y, vx, vy = self.entities[i].tolist()
+        elapsed = self.time - self.stamps[i]
+        x += vx * elapsed
+        y += vy * elapsed
+        t, j = self.get_boundary_event(i, x, y, vx, vy)
+        # После удара о частицу j повторное столкновение с ней невозможно,
+        # пока одна из них не испытает другое событие
+        partner = self.partners[i]
+        candidates = [k for key in self.neighbours[self.cells[i]] for k in self.members[key] if k != i and k != partner]
+        if candidates:
+            contact = (2 * self.radius) ** 2
+            rows = self.entities[candidates].tolist()
+            elapsed = (self.time - self.stamps[candidates]).tolist()
+            for k, (kx, ky, kvx, kvy), dt in zip(candidates, rows, elapsed):
+                dx = kx + kvx * dt - x
+                dy = ky + kvy * dt - y
+                if self.periodic:
+                    dx -= self.width * round(dx / self.width)
+                    dy -= self.height * round(dy / self.height)
+                dvx = kvx - vx
+                dvy = kvy - vy
+                b = dx * dvx + dy * dvy
+                if b >= 0:
+                    continue
+                dv2 = dvx * dvx + dvy * dvy
+                d = b * b - dv2 * (dx * dx + dy * dy - contact)
+                if d < 0:
+                    continue
+                time = max((-b - math.sqrt(d)) / dv2, 0.0)
+                if time < t:
+                    t, j = time, k
+        if t < math.inf:
+            heapq.heappush(self.heap, (self.time + t, i, j, int(self.counts[i]), int(self.counts[j]) if j >= 0 else 0))
+
+    def move(self, i, time):
+        self.entities[i, 0:2] += self.entities[i, 2:4] * (time - self.stamps[i])
+        self.stamps[i] = time
+        if self.periodic:
+            self.entities[i, 0] %= self.width
+            self.entities[i, 1] %= self.height
+
+    def cross(self, i, axis):
+        # Переход в соседнюю клетку по направлению скорости; скорость не меняется,
+        # поэтому события других частиц с участием i остаются верными.
+        # Частица ставится точно на общую границу клеток (в периодическом ящике - со стороны новой клетки)
+        cell = [self.cells[i] % self.nx, self.cells[i] // self.nx]
+        bounds = self.x_bounds if axis == 0 else self.y_bounds
+        step = 1 if self.entities[i, 2 + axis] > 0 else -1
+        cell[axis] = (cell[axis] + step) % (len(bounds) - 1)
+        self.entities[i, axis] = bounds[cell[axis]] if step > 0 else bounds[cell[axis] + 1]
+        cx, cy = cell
+        self.members[self.cells[i]].discard(i)
+        self.cells[i] = cy * self.nx + cx
+        self.members[self.cells[i]].add(i)
+
+    def advance(self, time):
+        while len(self.heap) > 0 and self.heap[0][0] <= time:
+            t, i, j, ci, cj = heapq.heappop(self.heap)
+            if self.counts[i] != ci:
+                continue
+            if j >= 0 and self.counts[j] != cj:
+                self.predict(i)
+                continue
+            self.time = t
+            self.move(i, t)
+            if j in (X_CELL, Y_CELL):
+                self.cross(i, 0 if j == X_CELL else 1)
+                self.predict(i)
+                continue
+            if j >= 0:
+                self.move(j, t)
+                r_diff = self.entities[j, 0:2] - self.entities[i, 0:2]
+                if self.periodic:
+                    r_diff = get_min_image(r_diff, self.width, self.height)
+                dot = np.sum((self.entities[j, 2:4] - self.entities[i, 2:4]) * r_diff)
+                temp = r_diff * (dot / np.sum(r_diff ** 2))
+                self.entities[j, 2:4] -= temp
+                self.entities[i, 2:4] += temp
+                self.counts[j] += 1
+                self.partners[i] = j
+                self.partners[j] = i
+            elif j != CHECK:
+                axis = 0 if j == X_WALL else 1
+                bound = self.width if axis == 0 else self.height
+                self.entities[i, axis] = bound if self.entities[i, 2 + axis] > 0 else 0
+                self.entities[i, 2 + axis] *= -1
+                self.partners[i] = -1
+            self.counts[i] += 1
+            self.processed += 1
+            self.predict(i)
+            if j >= 0:
+                self.predict(j)
+        self.time = time
+        self.sync()
+
+    def sync(self):
+        self.entities[:, 0:2] += self.entities[:, 2:4] * (self.time - self.stamps)[:, np.newaxis]
+        self.stamps[:] = self.time
+        if self.periodic:
+            self.entities[:, 0] %= self.width
+            self.entities[:, 1] %= self.height
+
+    def update(self, indices):
+        # Скорости (и, возможно, положения) частиц indices изменены извне (например, ударом о диполь)
+        for i in indices:
+            self.counts[i] += 1
+            self.partners[i] = -1
+        self.set_cells(indices)
+        for i in indices:
+            self.predict(i)
+
+    def insert(self, entities, indices):
+        # В entities добавлены строки indices (в конец, на момент time); события остальных частиц
+        # не меняются: столкновение с новой частицей найдётся из её собственного предсказания
+        self.entities = entities
+        self.stamps = np.concatenate((self.stamps, np.full(len(indices), self.time)))
+        self.counts = np.concatenate((self.counts, np.zeros(len(indices), dtype=np.int64)))
+        self.partners = np.concatenate((self.partners, np.full(len(indices), -1, dtype=np.int64)))
+        self.cells = np.concatenate((self.cells, np.zeros(len(indices), dtype=np.int64)))
+        self.set_cells(indices)
+        for i in indices:
+            self.predict(i)
+
+    def remove(self, entities, keep):
+        # В entities остались только строки keep (по возрастанию, на момент time). События удалённых
+        # частиц выбрасываются, частицы, чьё событие было с удалённой, предсказываются заново
+        rank = np.full(len(self.stamps), -1, dtype=np.int64)
+        rank[keep] = np.arange(len(keep))
+        self.entities = entities
+        self.stamps = self.stamps[keep]
+        self.counts = self.counts[keep]
+        self.partners = np.where(self.partners >= 0, rank[self.partners], -1)[keep]
+        self.cells = self.cells[keep]
+        self.members = [set() for _ in range(self.nx * self.ny)]
+        for i, key in enumerate(self.cells.tolist()):
+            self.members[key].add(i)
+        heap = []
+        lost = set()
+        for t, i, j, ci, cj in self.heap:
+            if rank[i] < 0:
+                continue
+            if j >= 0 and rank[j] < 0:
+                # Устаревшие события выбрасываются молча: у частицы есть и действующее
+                if self.counts[rank[i]] == ci:
+                    lost.add(int(rank[i]))
+                continue
+            heap.append((t, int(rank[i]), int(rank[j]) if j >= 0 else j, ci, cj))
+        self.heap = heap
+        heapq.heapify(self.heap)
+        for i in sorted(lost):
+            self.predict(i)
+
+    def permute(self, order):
+        # Строки entities переставлены на месте: новая строка i - бывшая строка order[i].
+        # Состояние очереди переносится без пересчёта событий
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        self.stamps = self.stamps[order]
+        self.counts = self.counts[order]
+        self.partners = np.where(self.partners >= 0, rank[self.partners], -1)[order]
+        self.cells = self.cells[order]
+        self.members = [{int(rank[i]) for i in members} for members in self.members]
+        self.heap = [(t, rank[i], rank[j] if j >= 0 else j, ci, cj) for t, i, j, ci, cj in self.heap]
+        heapq.heapify(self.heap)
+
+    def rescale(self, coef):
+        # Все скорости умножены на coef: траектории те же, время до событий делится на coef.
+        if coef <= 0:
+            self.reset()
+            return
+        # Заодно выбрасываются устаревшие события, владелец которых с тех пор испытал другое событие
+        self.heap = [(self.time + (t - self.time) / coef, i, j, ci, cj) for t, i, j, ci, cj in self.heap if self.counts[i] == ci]
+        heapq.heapify(self.heap)
@@ -0,0 +1,77 @@
+import math
+import numpy as np
+from collisions import get_min_image
+
+# Параметр разбиения: erfc(EWALD_SPLIT) ~ 7e-7, так что действительная часть обрывается
+# на половине ящика, а обратная - на |G| = 2 * EWALD_SPLIT * alpha
+EWALD_SPLIT = 3.5
+
+
+def erfc(x):
+    # Дополнительная функция ошибок (Абрамовиц-Стиган 7.1.26, погрешность ~1.5e-7) для x >= 0
+    t = 1 / (1 + 0.3275911 * x)
+    poly = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429))))
+    return poly * np.exp(-x * x)
+
+
+class Ewald:
+    # Суммирование Эвальда для потенциала 1/r в плоском периодическом ящике (заряды в плоскости z = 0).
+    # Гладкая часть взаимодействия всех образов считается в обратном пространстве, а для ближайших
+    # образов она заменяется сглаженным законом K q1 q2 d / (d + s)^3, которым пользуется система.
+    # Заряды одного диполя (индексы 2k и 2k + 1) друг с другом не взаимодействуют,
+    # но с периодическими образами своего диполя - взаимодействуют.
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.area = width * height
+        self.alpha = EWALD_SPLIT / (min(width, height) / 2)
+        g_max = 2 * EWALD_SPLIT * self.alpha
+        mx = math.ceil(g_max * width / (2 * math.pi))
+        my = math.ceil(g_max * height / (2 * math.pi))
+        grid = np.array(np.meshgrid(np.arange(-mx, mx + 1), np.arange(-my, my + 1))).T.reshape(-1, 2)
+        vectors = 2 * math.pi * grid / np.array([width, height])
+        size = np.sqrt(np.sum(vectors ** 2, axis=1))
+        keep = (size > 0) & (size <= g_max)
+        self.vectors = vectors[keep]
+        size = size[keep]
+        self.weights = 2 * math.pi / self.area * erfc(size / (2 * self.alpha)) / size
+
+    def get_structure(self, points, charges):
+        phase = points @ self.vectors.T
+        cos = np.cos(phase)
+        sin = np.sin(phase)
+        return cos, sin, charges @ cos, charges @ sin
+
+    def get_pairs(self, points):
+        diff = get_min_image(points[:, np.newaxis, :] - points[np.newaxis, :, :], self.width, self.height)
+        dist = np.sqrt(np.sum(diff ** 2, axis=-1))
+        n = points.shape[0]
+        index = np.arange(n)
+        other = (index[:, np.newaxis] >> 1) != (index[np.newaxis, :] >> 1)
+        own = ~other & (index[:, np.newaxis] != index[np.newaxis, :])
+        np.fill_diagonal(dist, 1.0)
+        return diff, dist, other, own
+
+    def get_forces(self, points, charges, softening, k):
+        # (N, 2) точки и (N,) заряды -> (N, 2) силы
+        cos, sin, s_cos, s_sin = self.get_structure(points, charges)
+        forces = ((sin * s_cos - cos * s_sin) * self.weights) @ self.vectors
+
+        diff, dist, other, own = self.get_pairs(points)
+        ad = self.alpha * dist
+        smooth = (1 - erfc(ad)) / dist ** 2 - 2 * self.alpha / math.sqrt(math.pi) * np.exp(-ad * ad) / dist
+        coef = other / (dist + softening) ** 3 - (other | own) * smooth / dist
+        forces += np.sum((coef * charges[np.newaxis, :])[..., np.newaxis] * diff, axis=1)
+        return k * charges[:, np.newaxis] * forces
+
+    def get_energy(self, points, charges, softening, k):
+        # Энергия с точностью до постоянной, согласованная с get_forces
+        cos, sin, s_cos, s_sin = self.get_structure(points, charges)
+        energy = np.sum(self.weights * (s_cos ** 2 + s_sin ** 2 - np.sum(charges ** 2))) / 2
+
+        diff, dist, other, own = self.get_pairs(points)
+        soft = (2 * dist + softening) / (2 * (dist + softening) ** 2)
+        smooth = (1 - erfc(self.alpha * dist)) / dist
+        pair = charges[:, np.newaxis] * charges[np.newaxis, :] * (other * soft - (other | own) * smooth)
+        energy += np.sum(pair) / 2
+        return k * energy
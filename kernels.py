@@ -0,0 +1,297 @@
+import math
+import warnings
+import numpy as np
+from collisions import get_min_image, get_pair_order, resolve_pairs
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Наибольшее число клеток вдоль стороны ящика в поиске контактов
+MAX_CELLS = 1024
+
+
+class NumpyKernels:
+    # Эталонные ядра шага на NumPy. Объект создаётся на каждую систему:
+    # в нём лежат буферы для сил между зарядами (allocate вызывается при смене числа диполей)
+    name = 'numpy'
+
+    def allocate(self, n):
+        signs = np.tile([1.0, -1.0], n)
+        owner = np.repeat(np.arange(n), 2)
+        self.pair_signs = np.outer(signs, signs) * (owner[:, np.newaxis] != owner[np.newaxis, :])
+        self.diff_buffer = np.zeros((2 * n, 2 * n, 2))
+        self.dist_buffer = np.zeros((2 * n, 2 * n))
+
+    def advect(self, entities, dt, width, height, periodic):
+        # Перенос молекул на dt; у стенок - отражение, в периодическом ящике - возврат в ящик
+        entities[:, 0] += entities[:, 2] * dt
+        entities[:, 1] += entities[:, 3] * dt
+        if periodic:
+            entities[:, 0] %= width
+            entities[:, 1] %= height
+            return
+        mask = entities[:, 0] < 0
+        entities[mask, 0] = 0
+        entities[mask, 2] *= -1
+        mask = entities[:, 0] > width
+        entities[mask, 0] = width
+        entities[mask, 2] *= -1
+        mask = entities[:, 1] < 0
+        entities[mask, 1] = 0
+        entities[mask, 3] *= -1
+        mask = entities[:, 1] > height
+        entities[mask, 1] = height
+        entities[mask, 3] *= -1
+
+    def get_contacts(self, entities, points, reach, width, height, periodic):
+        # Пары (заряд, молекула) ближе reach, упорядоченные по заряду, затем по молекуле
+        owners = []
+        index = []
+        for i, pos in enumerate(points):
+            diff = entities[:, 0:2] - pos
+            if periodic:
+                diff = get_min_image(diff, width, height)
+            close = np.flatnonzero(np.sum(diff ** 2, axis=1) < reach ** 2)
+            owners.append(np.full(len(close), i))
+            index.append(close)
+        if len(owners) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(owners).astype(np.int64), np.concatenate(index).astype(np.int64)
+
+    def resolve_pairs(self, entities, first, second, width, height, periodic):
+        # Упругие удары молекул в парах, от самых глубоких перекрытий к самым мелким
+        resolve_pairs(entities, first, second, box=(width, height) if periodic else None)
+
+    def collide_elastic(self, entities, index, pos, arm, c_vel, m, mass, inertial, width, height, periodic):
+        # Упругие удары молекул index о заряд в точке pos (плечо arm, скорость c_vel) по очереди.
+        # Возвращает маску ударивших молекул и изменения скорости и угловой скорости диполя (массы mass)
+        normal = np.array([-arm[1], arm[0]])
+        hit = np.zeros(len(index), dtype=bool)
+        dv = np.zeros(2)
+        dw = 0.0
+        for s, j in enumerate(index):
+            r_diff = entities[j, 0:2] - pos
+            if periodic:
+                r_diff = get_min_image(r_diff, width, height)
+            unit = r_diff / math.sqrt(np.sum(r_diff ** 2))
+            approach = np.dot(entities[j, 2:4] - c_vel, unit)
+            if approach >= 0:
+                continue
+            lever = arm[0] * unit[1] - arm[1] * unit[0]
+            impulse = -2 * approach / (1 / m + 1 / mass + lever ** 2 / inertial)
+            entities[j, 2:4] += unit * impulse / m
+            dv -= unit * impulse / mass
+            dw -= impulse * lever / inertial
+            c_vel = c_vel - unit * impulse / mass - normal * impulse * lever / inertial
+            hit[s] = True
+        return hit, dv, dw
+
+    def get_forces(self, points, softening, out):
+        # Сумма sign_i sign_j (p_i - p_j) / (d + s)^3 по зарядам других диполей: (2M, 2) -> out
+        diff = self.diff_buffer
+        dist = self.dist_buffer
+        np.subtract(points[:, np.newaxis, :], points[np.newaxis, :, :], out=diff)
+        np.einsum('ijk,ijk->ij', diff, diff, out=dist)
+        np.sqrt(dist, out=dist)
+        dist += softening
+        np.power(dist, 3, out=dist)
+        np.divide(self.pair_signs, dist, out=dist)
+        np.einsum('ij,ijk->ik', dist, diff, out=out)
+        return out
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def wrap(value, size):
+        return value - size * np.round(value / size)
+
+    @numba.njit(cache=True)
+    def advect_kernel(entities, dt, width, height, periodic):
+        for i in range(entities.shape[0]):
+            for axis, bound in ((0, width), (1, height)):
+                x = entities[i, axis] + entities[i, 2 + axis] * dt
+                if periodic:
+                    x %= bound
+                elif x < 0:
+                    x = 0
+                    entities[i, 2 + axis] *= -1
+                elif x > bound:
+                    x = bound
+                    entities[i, 2 + axis] *= -1
+                entities[i, axis] = x
+
+    @numba.njit(cache=True)
+    def contacts_kernel(entities, points, reach, width, height, periodic):
+        # Молекулы раскладываются сортировкой подсчётом по клеткам со стороной не меньше reach,
+        # для каждой точки просматриваются только соседние клетки. Найденные пары дописываются
+        # в буферы, которые удваиваются при заполнении
+        n = entities.shape[0]
+        nx = max(min(int(width // reach), MAX_CELLS), 1)
+        ny = max(min(int(height // reach), MAX_CELLS), 1)
+        cells = np.empty(n, dtype=np.int64)
+        starts = np.zeros(nx * ny + 1, dtype=np.int64)
+        for i in range(n):
+            cx = min(max(int(entities[i, 0] * nx / width), 0), nx - 1)
+            cy = min(max(int(entities[i, 1] * ny / height), 0), ny - 1)
+            cells[i] = cy * nx + cx
+            starts[cells[i] + 1] += 1
+        for c in range(nx * ny):
+            starts[c + 1] += starts[c]
+        fill = starts[:-1].copy()
+        order = np.empty(n, dtype=np.int64)
+        for i in range(n):
+            order[fill[cells[i]]] = i
+            fill[cells[i]] += 1
+
+        owners = np.empty(16, dtype=np.int64)
+        index = np.empty(16, dtype=np.int64)
+        total = 0
+        for k in range(points.shape[0]):
+            begin = total
+            px = points[k, 0]
+            py = points[k, 1]
+            if periodic:
+                px %= width
+                py %= height
+            cx = min(max(int(px * nx / width), 0), nx - 1)
+            cy = min(max(int(py * ny / height), 0), ny - 1)
+            # В периодическом ящике соседи берутся по модулю, без повторов при двух клетках и меньше
+            if periodic:
+                x_lo, x_hi = (0, nx - 1) if nx < 3 else (cx - 1, cx + 1)
+                y_lo, y_hi = (0, ny - 1) if ny < 3 else (cy - 1, cy + 1)
+            else:
+                x_lo, x_hi = max(cx - 1, 0), min(cx + 1, nx - 1)
+                y_lo, y_hi = max(cy - 1, 0), min(cy + 1, ny - 1)
+            for y in range(y_lo, y_hi + 1):
+                for x in range(x_lo, x_hi + 1):
+                    c = (y % ny) * nx + x % nx
+                    for s in range(starts[c], starts[c + 1]):
+                        i = order[s]
+                        dx = entities[i, 0] - points[k, 0]
+                        dy = entities[i, 1] - points[k, 1]
+                        if periodic:
+                            dx = wrap(dx, width)
+                            dy = wrap(dy, height)
+                        if dx * dx + dy * dy >= reach * reach:
+                            continue
+                        if total == len(owners):
+                            grown = np.empty(2 * total, dtype=np.int64)
+                            grown[:total] = owners
+                            owners = grown
+                            grown = np.empty(2 * total, dtype=np.int64)
+                            grown[:total] = index
+                            index = grown
+                        owners[total] = k
+                        index[total] = i
+                        total += 1
+            index[begin:total] = np.sort(index[begin:total])
+        return owners[:total], index[:total]
+
+    @numba.njit(cache=True)
+    def pairs_kernel(entities, first, second, width, height, periodic):
+        # Пары по порядку: партии без общих частиц в NumPy дают тот же результат
+        for s in range(len(first)):
+            i = first[s]
+            j = second[s]
+            dx = entities[j, 0] - entities[i, 0]
+            dy = entities[j, 1] - entities[i, 1]
+            if periodic:
+                dx = wrap(dx, width)
+                dy = wrap(dy, height)
+            dot = (entities[j, 2] - entities[i, 2]) * dx + (entities[j, 3] - entities[i, 3]) * dy
+            if dot < 0:
+                coef = dot / (dx * dx + dy * dy)
+                entities[j, 2] -= dx * coef
+                entities[j, 3] -= dy * coef
+                entities[i, 2] += dx * coef
+                entities[i, 3] += dy * coef
+
+    @numba.njit(cache=True)
+    def elastic_kernel(entities, index, pos, arm, c_vel, m, mass, inertial, width, height, periodic):
+        hit = np.zeros(len(index), dtype=np.bool_)
+        dv = np.zeros(2)
+        dw = 0.0
+        vx = c_vel[0]
+        vy = c_vel[1]
+        for s in range(len(index)):
+            j = index[s]
+            dx = entities[j, 0] - pos[0]
+            dy = entities[j, 1] - pos[1]
+            if periodic:
+                dx = wrap(dx, width)
+                dy = wrap(dy, height)
+            size = math.sqrt(dx * dx + dy * dy)
+            ux = dx / size
+            uy = dy / size
+            approach = (entities[j, 2] - vx) * ux + (entities[j, 3] - vy) * uy
+            if approach >= 0:
+                continue
+            lever = arm[0] * uy - arm[1] * ux
+            impulse = -2 * approach / (1 / m + 1 / mass + lever ** 2 / inertial)
+            entities[j, 2] += ux * impulse / m
+            entities[j, 3] += uy * impulse / m
+            dv[0] -= ux * impulse / mass
+            dv[1] -= uy * impulse / mass
+            dw -= impulse * lever / inertial
+            vx = vx - ux * impulse / mass + arm[1] * impulse * lever / inertial
+            vy = vy - uy * impulse / mass - arm[0] * impulse * lever / inertial
+            hit[s] = True
+        return hit, dv, dw
+
+    @numba.njit(cache=True)
+    def forces_kernel(points, softening, out):
+        out[:] = 0
+        count = points.shape[0]
+        for i in range(count):
+            for j in range(i + 1, count):
+                if i >> 1 == j >> 1:
+                    continue
+                dx = points[i, 0] - points[j, 0]
+                dy = points[i, 1] - points[j, 1]
+                coef = (1.0 - 2.0 * ((i ^ j) & 1)) / (math.sqrt(dx * dx + dy * dy) + softening) ** 3
+                out[i, 0] += coef * dx
+                out[i, 1] += coef * dy
+                out[j, 0] -= coef * dx
+                out[j, 1] -= coef * dy
+
+
+class NumbaKernels(NumpyKernels):
+    # Те же ядра, скомпилированные Numba: явные циклы по частицам вместо операций над массивами
+    name = 'numba'
+
+    def allocate(self, n):
+        pass
+
+    def advect(self, entities, dt, width, height, periodic):
+        advect_kernel(entities, dt, width, height, periodic)
+
+    def get_contacts(self, entities, points, reach, width, height, periodic):
+        return contacts_kernel(entities, np.ascontiguousarray(points, dtype=np.float64), reach, width, height, periodic)
+
+    def resolve_pairs(self, entities, first, second, width, height, periodic):
+        if len(first) == 0:
+            return
+        first, second = get_pair_order(entities, first, second, box=(width, height) if periodic else None)
+        pairs_kernel(entities, first, second, width, height, periodic)
+
+    def collide_elastic(self, entities, index, pos, arm, c_vel, m, mass, inertial, width, height, periodic):
+        return elastic_kernel(entities, index, pos, arm, c_vel, m, mass, inertial, width, height, periodic)
+
+    def get_forces(self, points, softening, out):
+        forces_kernel(points, softening, out)
+        return out
+
+
+BACKENDS = {NumpyKernels.name: NumpyKernels, NumbaKernels.name: NumbaKernels}
+
+
+def get_kernels(name):
+    # Ядра по имени; без установленного Numba вместо 'numba' используются ядра NumPy
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend: {name}")
+    if name == NumbaKernels.name and numba is None:
+        warnings.warn("Numba is not installed, falling back to the NumPy kernels")
+        name = NumpyKernels.name
+    return BACKENDS[name]()
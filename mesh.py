@@ -0,0 +1,93 @@
+import math
+import numpy as np
+
+
+class ParticleMesh:
+    # Поле точечных зарядов на равномерной сетке: заряды раскладываются по узлам (CIC),
+    # потенциал - свёртка с ядром (2d + s) / (2 (d + s)^2) через FFT, то есть тот же сглаженный
+    # закон K q1 q2 d / (d + s)^3, что и для диполей. Поле - центральные разности потенциала,
+    # обратно в точки интерполируется с теми же весами.
+    # Без периодичности сетка дополняется нулями вдвое, чтобы свёртка не заворачивалась.
+    def __init__(self, width, height, spacing, softening, periodic=False):
+        self.periodic = periodic
+        if periodic:
+            self.nx = max(int(round(width / spacing)), 1)
+            self.ny = max(int(round(height / spacing)), 1)
+            self.hx = width / self.nx
+            self.hy = height / self.ny
+            size = (self.nx, self.ny)
+        else:
+            self.nx = math.ceil(width / spacing) + 1
+            self.ny = math.ceil(height / spacing) + 1
+            self.hx = self.hy = spacing
+            size = (2 * self.nx, 2 * self.ny)
+        self.width = width
+        self.height = height
+        self.size = size
+        ix = np.arange(size[0])
+        iy = np.arange(size[1])
+        dx = np.minimum(ix, size[0] - ix) * self.hx
+        dy = np.minimum(iy, size[1] - iy) * self.hy
+        dist = np.sqrt(dx[:, np.newaxis] ** 2 + dy[np.newaxis, :] ** 2)
+        softening = max(softening, self.hx, self.hy)
+        self.kernel = np.fft.rfft2((2 * dist + softening) / (2 * (dist + softening) ** 2))
+
+    def get_weights(self, points):
+        # Номера четырёх узлов вокруг каждой точки в плоском массиве сетки и их веса;
+        # результат можно использовать и для раскладки, и для интерполяции
+        x = points[:, 0] / self.hx
+        y = points[:, 1] / self.hy
+        if self.periodic:
+            x = np.mod(x, self.nx)
+            y = np.mod(y, self.ny)
+            ix = np.floor(x).astype(np.int64)
+            iy = np.floor(y).astype(np.int64)
+        else:
+            x = np.clip(x, 0, self.nx - 1)
+            y = np.clip(y, 0, self.ny - 1)
+            ix = np.minimum(np.floor(x).astype(np.int64), self.nx - 2)
+            iy = np.minimum(np.floor(y).astype(np.int64), self.ny - 2)
+        fx = x - ix
+        fy = y - iy
+        jx = (ix + 1) % self.nx
+        jy = (iy + 1) % self.ny
+        index = np.empty((4, len(x)), dtype=np.int64)
+        weights = np.empty((4, len(x)))
+        np.multiply(ix, self.ny, out=index[0])
+        np.multiply(jx, self.ny, out=index[1])
+        index[2] = index[0]
+        index[3] = index[1]
+        index[0:2] += iy
+        index[2:4] += jy
+        np.subtract(1, fx, out=weights[0])
+        np.multiply(weights[0], fy, out=weights[2])
+        weights[0] -= weights[2]
+        np.multiply(fx, fy, out=weights[3])
+        np.subtract(fx, weights[3], out=weights[1])
+        return index, weights
+
+    def deposit(self, stencil, charges):
+        index, weights = stencil
+        grid = np.bincount(index.ravel(), weights=(weights * charges).ravel(), minlength=self.nx * self.ny)
+        return grid.reshape(self.nx, self.ny)
+
+    def solve(self, density):
+        padded = np.zeros(self.size)
+        padded[:self.nx, :self.ny] = density
+        potential = np.fft.irfft2(np.fft.rfft2(padded) * self.kernel, s=self.size)
+        return potential[:self.nx, :self.ny]
+
+    def get_field(self, potential):
+        # Напряжённость E = -grad(потенциала), две сетки
+        if self.periodic:
+            ex = -(np.roll(potential, -1, axis=0) - np.roll(potential, 1, axis=0)) / (2 * self.hx)
+            ey = -(np.roll(potential, -1, axis=1) - np.roll(potential, 1, axis=1)) / (2 * self.hy)
+            return ex, ey
+        ex, ey = np.gradient(potential, self.hx, self.hy)
+        return -ex, -ey
+
+    def gather(self, grids, stencil):
+        # Значения сеток (..., nx, ny) в точках: (..., N)
+        index, weights = stencil
+        flat = grids.reshape(grids.shape[:-2] + (self.nx * self.ny,))
+        return np.sum(flat[..., index] * weights, axis=-2)
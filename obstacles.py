@@ -0,0 +1,118 @@
+import math
+import numpy as np
+from multipole import expand_ranges
+
+
+def get_segment_distance(points, start, end):
+    # Расстояние от точек до отрезков и единичная нормаль от отрезка к точке: (P, 2) -> (P,), (P, 2)
+    edge = end - start
+    length = np.maximum(np.sum(edge ** 2, axis=1), 1e-20)
+    t = np.clip(np.sum((points - start) * edge, axis=1) / length, 0, 1)
+    diff = points - (start + t[:, np.newaxis] * edge)
+    dist = np.sqrt(np.sum(diff ** 2, axis=1))
+    # Точка прямо на отрезке: нормаль берётся перпендикулярно отрезку
+    side = np.stack((-edge[:, 1], edge[:, 0]), axis=-1) / np.sqrt(length)[:, np.newaxis]
+    normal = np.where((dist > 1e-12)[:, np.newaxis], diff / np.maximum(dist, 1e-20)[:, np.newaxis], side)
+    return dist, normal
+
+
+class Obstacles:
+    # Неподвижные препятствия: отрезки (внутренние стенки) и круги. Для быстрого поиска они
+    # раскладываются по клеткам равномерной сетки (в формате CSR: starts, items) с запасом margin,
+    # так что для точки достаточно просмотреть препятствия одной её клетки. Номера items меньше
+    # числа отрезков - отрезки, остальные - круги. Стоимость запроса от числа препятствий
+    # почти не зависит, пока препятствия не скапливаются в одной клетке.
+    def __init__(self, width, height, segments=None, circles=None, margin=0.0, cell_size=None):
+        self.segments = np.zeros((0, 2, 2)) if segments is None else np.asarray(segments, dtype=float).reshape(-1, 2, 2)
+        self.circles = np.zeros((0, 3)) if circles is None else np.asarray(circles, dtype=float).reshape(-1, 3)
+        self.width = width
+        self.height = height
+        self.margin = margin
+        if cell_size is None:
+            # Клетка мельчает с ростом числа препятствий, чтобы на клетку их приходилось немного,
+            # но не становится меньше запаса margin
+            cell_size = min(4 * margin, math.sqrt(width * height / max(len(self), 1)))
+            cell_size = max(cell_size, margin, min(width, height) / 1024, 1e-9)
+        self.cell_size = cell_size
+        self.nx = max(math.ceil(width / cell_size), 1)
+        self.ny = max(math.ceil(height / cell_size), 1)
+
+        cells = []
+        items = []
+        half = cell_size * math.sqrt(2) / 2
+        for i, (start, end) in enumerate(self.segments):
+            ix, iy = self.get_box_cells(np.minimum(start, end), np.maximum(start, end))
+            # Из клеток рамки отрезка остаются только те, что действительно рядом с ним
+            centers = (np.stack((ix, iy), axis=-1) + 0.5) * cell_size
+            dist, _ = get_segment_distance(centers, np.broadcast_to(start, centers.shape), np.broadcast_to(end, centers.shape))
+            near = dist <= half + margin
+            cells.append(ix[near] * self.ny + iy[near])
+            items.append(np.full(np.count_nonzero(near), i))
+        for i, (x, y, radius) in enumerate(self.circles):
+            ix, iy = self.get_box_cells(np.array([x - radius, y - radius]), np.array([x + radius, y + radius]))
+            cells.append(ix * self.ny + iy)
+            items.append(np.full(len(ix), len(self.segments) + i))
+        cells = np.concatenate(cells).astype(np.int64) if cells else np.zeros(0, dtype=np.int64)
+        items = np.concatenate(items).astype(np.int64) if items else np.zeros(0, dtype=np.int64)
+        order = np.argsort(cells, kind='stable')
+        self.items = items[order]
+        self.starts = np.searchsorted(cells[order], np.arange(self.nx * self.ny + 1))
+
+    def __len__(self):
+        return len(self.segments) + len(self.circles)
+
+    def get_box_cells(self, lower, upper):
+        # Все клетки, пересекающие прямоугольник [lower, upper], расширенный на margin
+        low = np.clip(np.floor((lower - self.margin) / self.cell_size).astype(np.int64), 0, (self.nx - 1, self.ny - 1))
+        high = np.clip(np.floor((upper + self.margin) / self.cell_size).astype(np.int64), 0, (self.nx - 1, self.ny - 1))
+        ix, iy = np.meshgrid(np.arange(low[0], high[0] + 1), np.arange(low[1], high[1] + 1), indexing='ij')
+        return ix.ravel(), iy.ravel()
+
+    def get_contacts(self, points, reach):
+        # Точки, которые ближе reach (не больше margin) к какому-нибудь препятствию:
+        # номера точек, нормали наружу из препятствия и глубины проникновения (по самому глубокому)
+        empty = np.zeros(0, dtype=np.int64), np.zeros((0, 2)), np.zeros(0)
+        if len(self) == 0 or len(points) == 0:
+            return empty
+        ix = np.clip((points[:, 0] // self.cell_size).astype(np.int64), 0, self.nx - 1)
+        iy = np.clip((points[:, 1] // self.cell_size).astype(np.int64), 0, self.ny - 1)
+        cell = ix * self.ny + iy
+        owners, slots = expand_ranges(np.arange(len(points)), self.starts[cell], self.starts[cell + 1])
+        if len(owners) == 0:
+            return empty
+        items = self.items[slots]
+        pos = points[owners]
+        dist = np.empty(len(owners))
+        normal = np.empty((len(owners), 2))
+
+        lines = items < len(self.segments)
+        if lines.any():
+            segments = self.segments[items[lines]]
+            dist[lines], normal[lines] = get_segment_distance(pos[lines], segments[:, 0], segments[:, 1])
+        rounds = ~lines
+        if rounds.any():
+            circles = self.circles[items[rounds] - len(self.segments)]
+            diff = pos[rounds] - circles[:, 0:2]
+            center = np.sqrt(np.sum(diff ** 2, axis=1))
+            dist[rounds] = center - circles[:, 2]
+            normal[rounds] = np.where((center > 1e-12)[:, np.newaxis], diff / np.maximum(center, 1e-20)[:, np.newaxis], [1.0, 0.0])
+
+        depth = reach - dist
+        inside = depth > 0
+        owners = owners[inside]
+        depth = depth[inside]
+        normal = normal[inside]
+        # Для каждой точки остаётся самое глубокое касание
+        order = np.lexsort((-depth, owners))
+        owners = owners[order]
+        first = np.concatenate(([True], owners[1:] != owners[:-1])) if len(owners) else np.zeros(0, dtype=bool)
+        return owners[first], normal[order][first], depth[order][first]
+
+    def reflect(self, positions, velocities, reach):
+        # Зеркальное отражение точек от препятствий на месте; возвращает номера отражённых
+        index, normal, depth = self.get_contacts(positions, reach)
+        positions[index] += normal * depth[:, np.newaxis]
+        approach = np.sum(velocities[index] * normal, axis=1)
+        hit = approach < 0
+        velocities[index[hit]] -= 2 * approach[hit, np.newaxis] * normal[hit]
+        return index
@@ -1,47 +1,350 @@
 from dataclasses import dataclass
 import numpy as np
-import pygame
-from pygame.math import Vector2
 from domain import *
+from collisions import get_cell_pairs, get_cross_pairs, get_min_image, get_morton_order
+from events import EventQueue
+from multipole import get_tree_forces, get_tree_potential
+from ewald import Ewald
+from clusters import get_cluster_labels
+from mesh import ParticleMesh
+from obstacles import Obstacles
+from kernels import get_kernels
 import math
 from copy import deepcopy
 
 EPS = 1e-20
 K = 9e9 * 1e1
 MIN_DIST = 20
+# Автоматический выбор числа подшагов диполей: за подшаг заряд смещается не больше
+# чем на SUBSTEP_FRACTION * r
+SUBSTEP_FRACTION = 0.05
+MAX_SUBSTEPS = 64
+# Непрерывная проверка ударов: за один отрезок пути диполь поворачивается не больше чем на SWEEP_ANGLE
+SWEEP_ANGLE = 0.2
+MAX_SWEEP_SEGMENTS = 32
 
 class DipoleState(Enum):
     NORMAL = 1
     STUCK = 2
 
-def get_kinetic(dipole: Dipole, mass=1, d_radius=5, r=15, center=None):
-    if center is None:
-        return mass * np.sum(dipole.c_vel ** 2) + 0.5 * mass * ((4 * (d_radius ** 2) / 5) + (2 * (r ** 2))) * (dipole.w ** 2)
-    p_1, p_2 = dipole.get_positions()
-    r1 = np.linalg.norm(center - p_1).item()
-    r2 = np.linalg.norm(center - p_2).item()
-    return mass * np.sum(dipole.c_vel ** 2) + 0.5 * mass * ((4 * (d_radius ** 2) / 5) + (r1 ** 2) + (r2 ** 2)) * (dipole.w ** 2)
-
-class Dipole:
-    def __init__(self, pos: np.array = np.array([0, 0]), r: float = 15, actangle: float=0, 
-                c_vel: np.array = np.array([0, 0]).astype(float), w: float = 0, state=DipoleState.NORMAL):
-        self.pos: np.ndarray = pos
-        self.actangle: float = actangle
-        self.c_vel: np.ndarray = c_vel
-        self.w: float = w
-        self.state: DipoleState = state
-        self.r = r
-
-    def get_positions(self):
-        pos1 = self.pos + np.array([self.r * math.cos(self.actangle), self.r * math.sin(self.actangle)])
-        pos2 = self.pos - np.array([self.r * math.cos(self.actangle), self.r * math.sin(self.actangle)])
-        return pos1, pos2
-    
-    def __add__(self, dipole: Dipole):
-        return Dipole(self.pos + dipole.pos, self.r, self.actangle + dipole.actangle, self.c_vel + dipole.c_vel, self.w + dipole.w, self.state)
-
-    def __truediv__(self, num):
-        return Dipole(self.pos / num, self.r, self.actangle / num, self.c_vel / num, self.w / num, self.state)
+class Engine(Enum):
+    STEP = 1
+    EVENT = 2
+    # Газ не моделируется явно: диполи испытывают трение и случайную силу (уравнение Ланжевена)
+    LANGEVIN = 3
+
+class Integrator(Enum):
+    RK4 = 1
+    DOPRI5 = 2
+    VERLET = 3
+    YOSHIDA4 = 4
+
+# Симплектические схемы как композиции шагов Верле с весами (Йошида, 4-й порядок)
+SYMPLECTIC_WEIGHTS = {
+    Integrator.VERLET: [1.0],
+    Integrator.YOSHIDA4: [1 / (2 - 2 ** (1 / 3)), -2 ** (1 / 3) / (2 - 2 ** (1 / 3)), 1 / (2 - 2 ** (1 / 3))],
+}
+
+# Таблица Бутчера метода Дормана-Принса 5(4)
+DOPRI_A = [
+    np.array([1 / 5]),
+    np.array([3 / 40, 9 / 40]),
+    np.array([44 / 45, -56 / 15, 32 / 9]),
+    np.array([19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729]),
+    np.array([9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656]),
+    np.array([35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84]),
+]
+DOPRI_E = np.array([71 / 57600, 0, -71 / 16695, 71 / 1920, -17253 / 339200, 22 / 525, -1 / 40])
+
+def cross(a, b):
+    return a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+
+def get_kinetic(c_vel, w, mass=1, d_radius=5, r=15, arms=None):
+    # arms - сумма квадратов расстояний зарядов до центра вращения (по умолчанию - центр диполя)
+    if arms is None:
+        arms = 2 * (r ** 2)
+    return mass * np.sum(c_vel ** 2, axis=-1) + 0.5 * mass * ((4 * (d_radius ** 2) / 5) + arms) * (w ** 2)
+
+def get_gas_energy(vel, m):
+    # Кинетическая энергия молекул; сумма всегда накапливается в float64
+    return m * np.sum(np.square(vel, dtype=np.float64)) / 2
+
+def sample_sites(total, size):
+    # min(size, total) различных случайных чисел из range(total) в случайном порядке;
+    # при size много меньше total - без перестановки всего диапазона
+    if 4 * size >= total:
+        return np.random.permutation(total)[:size]
+    index = np.random.randint(0, total, 2 * size)
+    while True:
+        index = np.sort(index)
+        index = index[np.concatenate(([True], index[1:] != index[:-1]))]
+        if len(index) >= size:
+            return np.random.permutation(index)[:size]
+        index = np.concatenate((index, np.random.randint(0, total, size)))
+
+def get_charge_positions(pos, actangle, r):
+    # (..., M, 2) и (..., M) -> (..., M, 2, 2): заряд 0 положительный, заряд 1 отрицательный
+    arm = r * np.stack((np.cos(actangle), np.sin(actangle)), axis=-1)
+    return np.stack((pos + arm, pos - arm), axis=-2)
+
+def get_charge_velocities(c_vel, actangle, w, r):
+    tangent = (r * w)[..., np.newaxis] * np.stack((-np.sin(actangle), np.cos(actangle)), axis=-1)
+    return np.stack((c_vel + tangent, c_vel - tangent), axis=-2)
+
+def get_charge_forces(charges, charge, softening):
+    # Кулоновские силы между зарядами разных диполей для всех пар сразу: (..., M, 2, 2)
+    m = charges.shape[-3]
+    points = charges.reshape(charges.shape[:-3] + (2 * m, 2))
+    signs = np.tile([1.0, -1.0], m)
+    owner = np.repeat(np.arange(m), 2)
+    diff = points[..., :, np.newaxis, :] - points[..., np.newaxis, :, :]
+    dist = np.sqrt(np.sum(diff ** 2, axis=-1))
+    coef = K * (charge ** 2) * np.outer(signs, signs) * (owner[:, np.newaxis] != owner[np.newaxis, :]) / (dist + softening) ** 3
+    forces = np.sum(coef[..., np.newaxis] * diff, axis=-2)
+    return forces.reshape(charges.shape)
+
+def get_charge_potential(charges, charge, softening):
+    # Потенциал, согласованный с силой K q1 q2 d / (d + s)^3: U = K q1 q2 (2d + s) / (2 (d + s)^2)
+    m = charges.shape[-3]
+    points = charges.reshape(charges.shape[:-3] + (2 * m, 2))
+    signs = np.tile([1.0, -1.0], m)
+    owner = np.repeat(np.arange(m), 2)
+    diff = points[..., :, np.newaxis, :] - points[..., np.newaxis, :, :]
+    dist = np.sqrt(np.sum(diff ** 2, axis=-1))
+    upper = np.triu(owner[:, np.newaxis] != owner[np.newaxis, :], 1)
+    energy = K * (charge ** 2) * np.outer(signs, signs) * (2 * dist + softening) / (2 * (dist + softening) ** 2)
+    return np.sum(energy * upper, axis=(-2, -1))
+
+def get_dipole_potential(pos, actangle, r, charge, softening):
+    # Энергия диполь-дипольного взаимодействия, просуммированная по всем парам диполей
+    arm = r * np.stack((np.cos(actangle), np.sin(actangle)), axis=-1)
+    p = 2 * charge * arm
+    diff = pos[..., :, np.newaxis, :] - pos[..., np.newaxis, :, :]
+    r_size = np.sqrt(np.sum(diff ** 2, axis=-1))
+    pp = np.sum(p[..., :, np.newaxis, :] * p[..., np.newaxis, :, :], axis=-1)
+    p1r = np.sum(p[..., :, np.newaxis, :] * diff, axis=-1)
+    p2r = np.sum(p[..., np.newaxis, :, :] * diff, axis=-1)
+    energy = K * (pp * (r_size ** 2) - 3 * p1r * p2r) / ((r_size + softening) ** 5)
+    upper = np.triu(np.ones(energy.shape[-2:], dtype=bool), 1)
+    return np.sum(energy * upper, axis=(-2, -1))
+
+# Шаг диполей по вектору состояния (..., 6M): положения (M, 2), углы, скорости (M, 2), угловые скорости.
+# Функции ниже общие для ParticleSystem (состояние (6M,)) и Ensemble (состояния реплик (B, 6M)).
+# Номера диполей и кластеров в них сквозные по всем осям пакета: диполь s - это [unravel_index(s, (..., M))]
+
+def get_state_views(state):
+    n = state.shape[-1] // 6
+    shape = state.shape[:-1]
+    return (state[..., 0:2 * n].reshape(shape + (n, 2)), state[..., 2 * n:3 * n],
+            state[..., 3 * n:5 * n].reshape(shape + (n, 2)), state[..., 5 * n:6 * n])
+
+def runge_knuta_4(derivatives, y, stages, stage, dt):
+    # Шаг RK4 без выделения памяти: stages - буферы k1..k4, stage - буфер промежуточного состояния
+    k1, k2, k3, k4 = stages[:4]
+    derivatives(y, k1)
+    np.multiply(k1, dt / 2, out=stage)
+    stage += y
+    derivatives(stage, k2)
+    np.multiply(k2, dt / 2, out=stage)
+    stage += y
+    derivatives(stage, k3)
+    np.multiply(k3, dt, out=stage)
+    stage += y
+    derivatives(stage, k4)
+    # y += dt / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+    k2 += k3
+    k2 *= 2
+    k2 += k1
+    k2 += k4
+    k2 *= dt / 6
+    y += k2
+
+def get_substeps(state, rates, r, dt):
+    # Число подшагов, при котором за подшаг заряд смещается не больше чем на SUBSTEP_FRACTION * r;
+    # по самому быстрому диполю во всём пакете
+    _, _, c_vel, w = get_state_views(state)
+    _, _, accel, angular = get_state_views(rates)
+    speed = np.sqrt(np.sum(c_vel ** 2, axis=-1)) + r * np.abs(w)
+    accel = np.sqrt(np.sum(accel ** 2, axis=-1)) + r * np.abs(angular)
+    length = SUBSTEP_FRACTION * r
+    scale = max(np.max(speed) / length, math.sqrt(np.max(accel) / length), EPS)
+    return min(max(math.ceil(dt * scale), 1), MAX_SUBSTEPS)
+
+def get_clusters(cluster):
+    # Номер кластера для каждого слипшегося диполя (кластеры из одного диполя не считаются)
+    sizes = np.bincount(cluster, minlength=len(cluster))
+    stuck = np.flatnonzero(sizes[cluster] > 1)
+    _, body = np.unique(cluster[stuck], return_inverse=True)
+    return stuck, body
+
+def get_sticking(charges, first, second, bonds, box=None):
+    # Связи между диполями по кандидатам first < second (заряды charges - (M, 2, 2)).
+    # Новая связь возникает, если ближайшие заряды разноимённые и ближе MIN_DIST;
+    # связь рвётся, если диполи разошлись дальше MIN_DIST или ближайшими стали одноимённые.
+    # Возвращает связи, номера кластеров и маску слипшихся диполей
+    n = len(charges)
+    diff = charges[first][:, :, np.newaxis, :] - charges[second][:, np.newaxis, :, :]
+    if box is not None:
+        diff = get_min_image(diff, *box)
+    dist = np.sqrt(np.sum(diff ** 2, axis=-1))
+    distance = dist.min(axis=(1, 2))
+    same = np.array([[True, False], [False, True]])
+    closest = dist == distance[:, np.newaxis, np.newaxis]
+    stucks_pos = np.any(closest & ~same, axis=(1, 2))
+    stucks_neg = np.any(closest & same, axis=(1, 2))
+
+    bonded = np.isin(first * n + second, bonds[:, 0] * n + bonds[:, 1])
+    keep = (distance <= MIN_DIST) & np.where(bonded, ~stucks_neg, stucks_pos)
+    cluster = get_cluster_labels(n, first[keep], second[keep])
+    sizes = np.bincount(cluster, minlength=n)
+    return np.stack((first[keep], second[keep]), axis=-1), cluster, sizes[cluster] > 1
+
+def update_clusters(state, rates, stuck, body, integrate, dt, mass, inertial, box=None):
+    # Шаг dt: свободные диполи продвигаются integrate(dt), слипшиеся (stuck, кластеры body) -
+    # как твёрдые тела. Скорость и угловая скорость кластера находятся из суммарного импульса
+    # и момента импульса, так что при слипании они сохраняются. Внутренние силы взаимно
+    # уничтожаются, внешние (из rates на начало шага) дают общую силу и момент относительно центра масс.
+    d_pos, d_angle, d_vel, d_w = get_state_views(state)
+    _, _, accel, angular = get_state_views(rates)
+    index = np.unravel_index(stuck, d_w.shape)
+    force = mass * accel[index]
+    torque = inertial * angular[index]
+    pos = d_pos[index]
+    actangle = d_angle[index]
+    c_vel = d_vel[index]
+    w = d_w[index]
+    if len(stuck) < d_w.size:
+        integrate(dt)
+
+    count = np.bincount(body)
+    first = np.unique(body, return_index=True)[1]
+    offsets = pos - pos[first][body]
+    if box is not None:
+        offsets = get_min_image(offsets, *box)
+    center = np.stack([np.bincount(body, weights=offsets[:, axis]) for axis in (0, 1)], axis=-1) / count[:, np.newaxis]
+    arm = offsets - center[body]
+    center += pos[first]
+    body_inertial = np.bincount(body, weights=inertial + mass * np.sum(arm ** 2, axis=1))
+    velocity = np.stack([np.bincount(body, weights=c_vel[:, axis] + force[:, axis] / mass * dt) for axis in (0, 1)], axis=-1) / count[:, np.newaxis]
+    momentum = np.bincount(body, weights=inertial * w + mass * cross(arm, c_vel) + (torque + cross(arm, force)) * dt)
+    omega = momentum / body_inertial
+
+    dact = omega[body] * dt
+    cos = np.cos(dact)
+    sin = np.sin(dact)
+    arm = np.stack((cos * arm[:, 0] - sin * arm[:, 1], sin * arm[:, 0] + cos * arm[:, 1]), axis=-1)
+    d_pos[index] = center[body] + velocity[body] * dt + arm
+    d_angle[index] = actangle + dact
+    d_vel[index] = velocity[body] + omega[body][:, np.newaxis] * np.stack((-arm[:, 1], arm[:, 0]), axis=-1)
+    d_w[index] = omega[body]
+
+def add_cluster_kicks(state, dv, dw, stuck):
+    # Толчки слипшимся диполям входят в импульс и момент импульса кластера до его
+    # движения как твёрдого тела, иначе пересчёт скоростей кластера их усреднит.
+    # У этих диполей толчки обнуляются, у остальных они прибавляются после шага
+    _, _, d_vel, d_w = get_state_views(state)
+    index = np.unravel_index(stuck, d_w.shape)
+    d_vel[index] += dv[index]
+    d_w[index] += dw[index]
+    dv[index] = 0
+    dw[index] = 0
+
+def reflect_walls(state, cluster, r, width, height):
+    # Отражение зарядов от стенок; весь кластер слипшихся диполей сдвигается и отражается вместе
+    d_pos, d_angle, d_vel, d_w = get_state_views(state)
+    n = d_w.size
+    shape = d_w.shape
+    charges = get_charge_positions(d_pos, d_angle, r).reshape(n, 2, 2)
+    tangent = (d_w[..., np.newaxis] * np.stack((-np.sin(d_angle), np.cos(d_angle)), axis=-1)).reshape(n, 2)
+    w_vel = np.stack((tangent, -tangent), axis=1)
+    for axis, bound in ((0, width), (1, height)):
+        for low in (True, False):
+            if low:
+                out = charges[:, :, axis] < 0
+                shift = np.where(out, -charges[:, :, axis], 0).max(axis=1)
+                flip = np.any(out & (w_vel[:, :, axis] < 0), axis=1)
+            else:
+                out = charges[:, :, axis] > bound
+                shift = np.where(out, bound - charges[:, :, axis], 0).min(axis=1)
+                flip = np.any(out & (w_vel[:, :, axis] > 0), axis=1)
+            hit = out.any(axis=1)
+            if not hit.any():
+                continue
+            cluster_shift = np.zeros(n)
+            if low:
+                np.maximum.at(cluster_shift, cluster, shift)
+            else:
+                np.minimum.at(cluster_shift, cluster, shift)
+            shift = cluster_shift[cluster].reshape(shape)
+            hit = (np.bincount(cluster, weights=hit, minlength=n)[cluster] > 0).reshape(shape)
+            flip = (np.bincount(cluster, weights=flip, minlength=n)[cluster] > 0).reshape(shape)
+            d_pos[..., axis] += shift
+            d_vel[hit, axis] = np.abs(d_vel[hit, axis]) * (1 if low else -1)
+            d_w[flip] *= -1
+
+def hit_charges(gas, index, owner, pos, arm, c_vel, m, charge_mass, d_radius, r, box=None):
+    # Удары молекул index о заряды в схеме RK4: молекула index[i] бьёт заряд owner[i] из пакета
+    # зарядов pos (B, 2) с плечами arm и скоростями c_vel. Скорости молекул меняются на месте;
+    # возвращает маску ударивших молекул и толчки диполей этих зарядов dv (B, 2) и dw (B,)
+    r_diff = gas[index, 0:2] - pos[owner]
+    if box is not None:
+        r_diff = get_min_image(r_diff, *box)
+    r_mag2 = r_diff[:, 0] ** 2 + r_diff[:, 1] ** 2
+    dot = np.sum((m * gas[index, 2:4] - charge_mass * c_vel[owner]) * r_diff, axis=1)
+    mask = dot < 0
+    temp = r_diff[mask] * (dot[mask] / r_mag2[mask])[:, np.newaxis]
+    gas[index[mask], 2:4] -= temp / m
+    delta_v = np.stack([np.bincount(owner[mask], weights=temp[:, axis], minlength=len(pos)) for axis in (0, 1)], axis=-1) / charge_mass
+    inertial = charge_mass * ((2 * (d_radius ** 2) / 5) + (1 * (r ** 2)))
+    return mask, delta_v / 2, cross(arm, charge_mass * delta_v) / inertial
+
+def finish_step(system, dt, forced, gas, rescale, recount=True, bath=None):
+    # Конец шага после ударов газа, общий для ParticleSystem и Ensemble (system - любая из них; энергии
+    # реплик пакета - по последней оси): толчки от ударов, интегрирование диполей подшагами, сверка
+    # энергии газа при хранении с округлением (recount) и перемасштабирование скоростей диполей и газа
+    # к опорной энергии (rescale). bath(dt) - термостат после толчков. Возвращает энергии диполей,
+    # потенциальную энергию и множитель скоростей
+    d_pos, d_angle, d_vel, d_w = get_state_views(system.state)
+    kinetic = np.sum(system.get_kinetics(), axis=-1)
+    add_cluster_kicks(system.state, system.dv, system.dw, system.get_clusters()[0])
+    system.impulse_energy += np.sum(system.get_kinetics(), axis=-1) - kinetic
+    d_pos += system.dv * dt
+    d_angle += system.dw * dt
+    substeps = system.get_substeps(dt)
+    for i in range(substeps):
+        if i > 0:
+            system.reflect_dipoles()
+        system.update_dipoles(dt / substeps, forced=forced)
+    kinetic = np.sum(system.get_kinetics(), axis=-1)
+    d_vel += system.dv
+    d_w += system.dw
+    system.impulse_energy += np.sum(system.get_kinetics(), axis=-1) - kinetic
+    if bath is not None:
+        bath(dt)
+    if gas and recount and system.entities.dtype != np.float64:
+        # Удары молекул друг о друга в хранении с округлением сохраняют энергию лишь
+        # приближённо, накопленная энергия газа сверяется с пересчётом каждый шаг
+        system.gas_energy = system.get_full_particles_energy()
+    kinetics = system.get_kinetics()
+    potential = system.get_full_potential()
+    # Скаляры для одной системы, массивы (B,) для пакета
+    system.energy_error = np.zeros(np.shape(potential))[()]
+    coef = np.ones(np.shape(potential))[()]
+    if rescale:
+        # Потенциальная энергия от скоростей не зависит, а кинетическая квадратична по ним,
+        # поэтому нужный множитель находится сразу, без повторных пересчётов энергии
+        kin_est = (system.full + system.full_p) - potential
+        total = np.sum(kinetics, axis=-1) + system.gas_energy
+        assert np.all(kin_est / total >= 0), kin_est
+        system.energy_error = total - kin_est - system.impulse_energy
+        coef = np.sqrt(kin_est / total)
+        d_vel *= np.asarray(coef)[..., np.newaxis, np.newaxis]
+        d_w *= np.asarray(coef)[..., np.newaxis]
+        kinetics *= np.asarray(coef)[..., np.newaxis] ** 2
+        if gas:
+            system.entities[..., 2:4] *= np.asarray(coef, dtype=system.entities.dtype)[..., np.newaxis, np.newaxis]
+            system.gas_energy *= coef ** 2
+    return kinetics, potential, coef
 
 @dataclass
 class ParticleSystem:
@@ -56,153 +359,386 @@ class ParticleSystem:
     charge_mass: float
     m: float
     ITERATION: int = 0
-    dipoles = [Dipole(), Dipole()]
     prev_charge: float = 0
     prev_charge_mass: float = 0
     prev_m: float = 0
-    dv = [[0, 0], [0, 0]]
-    dw = [0, 0]
+    engine: Engine = Engine.STEP
+    n_dipoles: int = 2
+    # Дерево Барнса-Хата для сил между диполями включается при n_dipoles >= tree_min_dipoles;
+    # theta - точность (0 - всегда точное суммирование по всем парам). При theta = 0.3 средняя
+    # ошибка силы около 0.3%, наибольшая - единицы процентов (замеры в multipole.get_tree_forces);
+    # такое дерево обгоняет точную сумму ядер NumPy примерно с 1000 диполей
+    theta: float = 0.3
+    tree_min_dipoles: int = 1024
+    # Интегратор диполей; для DOPRI5 шаг внутри dt подбирается по допускам atol и rtol.
+    # VERLET и YOSHIDA4 - симплектические схемы: ошибка энергии ограничена,
+    # и перемасштабирование скоростей не нужно
+    integrator: Integrator = Integrator.RK4
+    atol: float = 1e-6
+    rtol: float = 1e-6
+    # Число подшагов диполей на один шаг газа (0 - выбирается автоматически по скоростям
+    # и ускорениям зарядов); газ и удары о диполи считаются один раз за шаг
+    substeps: int = 1
+    # Удары газа о заряды ищутся по путям за весь шаг, а не по перекрытию в конце шага
+    swept: bool = False
+    # Периодический ящик вместо стенок: расстояния до ближайшего образа,
+    # силы между диполями - суммированием Эвальда
+    periodic: bool = False
+    # Заряд молекул газа (знаки чередуются, газ в целом нейтрален). Если он не ноль,
+    # газ и диполи взаимодействуют через поле на сетке с шагом mesh_spacing
+    gas_charge: float = 0
+    mesh_spacing: float = 5.0
+    # Неподвижные препятствия внутри ящика: отрезки (S, 2, 2) и круги (C, 3) - центр и радиус
+    segments: np.ndarray = None
+    circles: np.ndarray = None
+    # Каждые reorder_every шагов молекулы газа переупорядочиваются вдоль кривой Мортона
+    # (0 - никогда); ids[i] - исходный номер молекулы в строке i
+    reorder_every: int = 0
+    # Тип хранения координат и скоростей газа (np.float32 вдвое сокращает память и трафик);
+    # энергии всегда считаются в float64
+    dtype: type = np.float64
+    # Реализация ядер шага: 'numpy' или 'numba' (без установленного Numba - ядра NumPy)
+    backend: str = 'numpy'
+    # Начальные скорости газа: распределение Максвелла со средней скоростью avg_vel
+    # (иначе у всех молекул скорость ровно avg_vel)
+    maxwell: bool = True
+    # Число строк, заранее выделенных под газ (0 - ровно count); entities - представление
+    # первых count строк буфера, так что добавление молекул не требует новой памяти
+    capacity: int = 0
+    # Сторона клетки сетки для поиска столкновений молекул (0 - диаметр молекулы);
+    # в более крупных клетках кандидатов больше, а клеток меньше
+    cell_size: float = 0
 
     def __post_init__(self) -> None:
-        # print(self.radius, self.d_radius)
-        x_space = np.linspace(self.radius, self.max_width - self.radius, int(self.max_width // (2.5 * self.radius)))
-        y_space = np.linspace(self.radius, self.max_height - self.radius, int(self.max_height // (2.5 * self.radius)))
-        
-        mesh = np.array(np.meshgrid(x_space, y_space)).T.reshape(-1, 2)
-        choice = np.random.choice(mesh.shape[0], self.count + 4)
-        x = mesh[choice][:, 0]
-        y = mesh[choice][:, 1]
-        if self.count > 0:
-
-            vx = np.random.uniform(-1, 1, self.count)
-            vy = np.random.uniform(-1, 1, self.count)
-            
-            zeroed = (vx == 0) & (vy == 0)
-            vx[zeroed] = 1
-            vy[zeroed] = -1
-
-            v_mag = np.sqrt(vx ** 2 + vy ** 2)
-            vx /= v_mag
-            vx *= self.avg_vel
-            vy /= v_mag
-            vy *= self.avg_vel
-
-            self.entities = np.vstack((x[:-4], y[:-4], vx, vy)).T
-
-        self.dipoles = [0, 0]
-        for i in range(2):
-            q0 = np.array([x[-2 - 2 * i], y[-2 - 2 * i]])
-            q1 = np.array([x[-1 - 2 * i], y[-1 - 2 * i]])
-            if i == 0:
-                q0[0] /= 2
-                q1[0] /= 2
-            else:
-                q0[0] /= 2
-                q1[0] /= 2
-                q0[0] += self.max_width / 2
-                q1[0] += self.max_width / 2
-            pos = (q0 + q1) / 2
-            dist = (q0 - q1) / 2
-            dist_size = np.sqrt(dist[0] ** 2 + dist[1] ** 2).item()
-            actangle = math.asin(dist[1] / dist_size)
-            if dist[0] < 0:
-                actangle += math.pi
-            self.dipoles[i] = Dipole(pos, self.r, actangle)
+        n = self.n_dipoles
+        # Диполь i размещается в i-й вертикальной полосе ширины max_width / n
+        x_space, y_space = self.get_lattice(2.5 * self.radius)
+        index = sample_sites(len(x_space) * len(y_space), 2 * n)
+        tail = np.stack((x_space[index // len(y_space)], y_space[index % len(y_space)]), axis=-1).reshape(n, 2, 2)
+        q0 = tail[:, 0].copy()
+        q1 = tail[:, 1].copy()
+        shift = np.arange(n) * self.max_width / n
+        q0[:, 0] = q0[:, 0] / n + shift
+        q1[:, 0] = q1[:, 0] / n + shift
+        dist = (q0 - q1) / 2
+        dist_size = np.sqrt(dist[:, 0] ** 2 + dist[:, 1] ** 2)
+        self.ewald = Ewald(self.max_width, self.max_height) if self.periodic else None
+        self.kernels = get_kernels(self.backend)
+        self.obstacles = None
+        if self.segments is not None or self.circles is not None:
+            self.obstacles = Obstacles(self.max_width, self.max_height, self.segments, self.circles, margin=max(self.radius, self.d_radius))
+        self.allocate_dipoles()
+        self.d_pos[:] = (q0 + q1) / 2
+        self.d_angle[:] = np.arcsin(dist[:, 1] / dist_size) + math.pi * (dist[:, 0] < 0)
+
+        size = self.count if self.engine != Engine.LANGEVIN else 0
+        self.buffer = np.zeros((max(self.capacity, size), 4), dtype=self.dtype, order='F')
+        self.entities = self.buffer[:size]
+        if size > 0:
+            self.entities[:, 0:2] = self.get_gas_positions()
+            self.entities[:, 2:4] = self.get_gas_velocities(size, self.avg_vel)
+        self.ids = np.arange(size)
+        self.d_state = np.full(n, DipoleState.NORMAL.value)
+        self.bonds = np.empty((0, 2), dtype=np.int64)
+        self.cluster = np.arange(n)
 
         MIN_DIST = self.r
+        self.mesh = None
+        self.mesh_field = None
+        if self.gas_charge != 0 and self.count > 0 and self.engine != Engine.LANGEVIN:
+            self.mesh = ParticleMesh(self.max_width, self.max_height, self.mesh_spacing, self.r, periodic=self.periodic)
+            # Знак заряда молекулы определяется её номером, знаки чередуются
+            self.gas_charges = self.gas_charge * np.where(self.ids % 2 == 0, 1.0, -1.0)
+            self.update_mesh(0)
         self.full = self.get_full_potential()
-        self.full_p = self.count * self.m * ((self.avg_vel) ** 2) / 2
+        # Кинетическая энергия газа хранится и меняется только при ударах о диполи
+        # и перемасштабировании скоростей: удары молекул друг о друга и о стенки её не меняют
+        self.gas_energy = self.get_full_particles_energy()
+        self.full_p = self.gas_energy
         self.prev_charge = self.charge
         self.prev_charge_mass = self.charge_mass
         self.prev_m = self.m
-        self.dv = np.array([[0, 0], [0, 0]])
-        self.dw = np.array([0, 0])
+        self.dv = np.zeros((n, 2))
+        self.dw = np.zeros(n)
+        # Ошибка интегрирования последнего шага, убранная перемасштабированием скоростей,
+        # без изменения энергии от ударов молекул о заряды (в схеме RK4 они не упругие)
+        self.energy_error = 0.0
+        self.impulse_energy = 0.0
+        self.events = None
+        if self.engine == Engine.EVENT and self.count > 0:
+            self.events = EventQueue(self.entities, self.radius, self.max_width, self.max_height, periodic=self.periodic, cell_size=self.get_cell_size())
+
+
+    def get_lattice(self, spacing):
+        # Оси решётки начальных положений; узел номер i - (x_space[i // len(y_space)], y_space[i % len(y_space)])
+        x_space = np.linspace(self.radius, self.max_width - self.radius, max(int(self.max_width // spacing), 1))
+        y_space = np.linspace(self.radius, self.max_height - self.radius, max(int(self.max_height // spacing), 1))
+        return x_space, y_space
+
+    def get_gas_positions(self):
+        # Молекулы ставятся в узлы решётки без повторов со случайным сдвигом внутри узла,
+        # так что они не перекрываются ни друг с другом, ни с зарядами диполей, ни с препятствиями.
+        # Если свободных узлов не хватает, решётка сгущается вплоть до шага в диаметр молекулы.
+        # Вся решётка не строится: берутся случайные узлы с запасом, так что время и память - O(count)
+        charges = self.get_charge_positions().reshape(2 * self.n_dipoles, 2)
+        for spacing in np.linspace(2.5, 2 * (1 + 1e-9), 6) * self.radius:
+            x_space, y_space = self.get_lattice(spacing)
+            index = sample_sites(len(x_space) * len(y_space), 2 * self.count + 16)
+            sites = np.stack((x_space[index // len(y_space)], y_space[index % len(y_space)]), axis=-1)
+            jitter = (spacing - 2 * self.radius) / 2
+            reach = self.radius + self.d_radius + jitter * math.sqrt(2)
+            # Узлы рядом с зарядами находятся через сетку клеток, а не перебором всех пар
+            free = np.ones(len(sites), dtype=bool)
+            free[get_cross_pairs(sites, charges, reach, self.max_width, self.max_height, reach, periodic=self.periodic)[0]] = False
+            if self.obstacles is not None:
+                free[self.obstacles.get_contacts(sites, min(self.radius + jitter * math.sqrt(2), self.obstacles.margin))[0]] = False
+            if np.count_nonzero(free) >= self.count:
+                break
+        else:
+            raise ValueError(f"Cannot place {self.count} particles of radius {self.radius} without overlaps")
+        positions = sites[free][:self.count]
+        return positions + np.random.uniform(-jitter, jitter, positions.shape)
+
+    def get_gas_velocities(self, size, average):
+        if self.maxwell:
+            # Двумерное распределение Максвелла: компоненты скорости нормальны,
+            # sigma = average * sqrt(2 / pi) даёт среднюю скорость average
+            return np.random.normal(0, average * math.sqrt(2 / math.pi), (size, 2))
+        velocities = np.random.uniform(-1, 1, (size, 2))
+        velocities[np.all(velocities == 0, axis=1)] = [1, -1]
+        return velocities * average / np.sqrt(np.sum(velocities ** 2, axis=1))[:, np.newaxis]
+
+    def set_entities(self, size):
+        # entities становится представлением первых size строк буфера; буфер при нехватке растёт вдвое
+        if size > len(self.buffer):
+            buffer = np.zeros((max(size, 2 * len(self.buffer)), 4), dtype=self.dtype, order='F')
+            buffer[:len(self.entities)] = self.entities
+            self.buffer = buffer
+        self.entities = self.buffer[:size]
+        self.count = size
+
+    def add_particles(self, number):
+        # Новые молекулы ставятся в случайные точки, свободные от молекул, зарядов и препятствий;
+        # скорости - с текущей средней скоростью газа
+        if number <= 0:
+            return
+        if self.engine == Engine.LANGEVIN:
+            self.count += number
+            self.reset_energy()
+            return
+        average = self.get_average_speed() if self.count > 0 else self.avg_vel
+        old = self.count
+        positions = self.get_free_positions(number)
+        self.set_entities(old + number)
+        self.entities[old:, 0:2] = positions
+        self.entities[old:, 2:4] = self.get_gas_velocities(number, average)
+        first = self.ids.max() + 1 if old > 0 else 0
+        self.ids = np.concatenate((self.ids, np.arange(first, first + number)))
+        if self.events is not None:
+            self.events.insert(self.entities, np.arange(old, old + number))
+        self.update_gas()
+
+    def remove_particles(self, number):
+        # Удаляются number случайных молекул, оставшиеся сдвигаются в начало буфера
+        number = min(number, self.count)
+        if number <= 0:
+            return
+        if self.engine == Engine.LANGEVIN:
+            self.count -= number
+            self.reset_energy()
+            return
+        keep = np.sort(np.random.permutation(self.count)[number:])
+        kept = self.entities[keep]
+        self.ids = self.ids[keep]
+        self.set_entities(len(keep))
+        self.entities[:] = kept
+        if self.events is not None and len(keep) > 0:
+            self.events.remove(self.entities, keep)
+        self.update_gas()
+
+    def resize(self, width, height):
+        # Ящик растягивается или сжимается вместе с содержимым: координаты молекул
+        # и центров диполей масштабируются, форма диполей не меняется
+        sx = width / self.max_width
+        sy = height / self.max_height
+        self.max_width = width
+        self.max_height = height
+        if len(self.entities) > 0:
+            self.entities[:, 0] = np.clip(self.entities[:, 0] * sx, 0, width)
+            self.entities[:, 1] = np.clip(self.entities[:, 1] * sy, 0, height)
+        self.d_pos[:, 0] *= sx
+        self.d_pos[:, 1] *= sy
+        self.ewald = Ewald(width, height) if self.periodic else None
+        if self.obstacles is not None:
+            # Препятствия масштабируются вместе с содержимым ящика; радиус круга - по меньшему
+            # множителю, так что точки снаружи круга снаружи и остаются
+            segments = self.obstacles.segments * [sx, sy]
+            circles = self.obstacles.circles * [sx, sy, min(sx, sy)]
+            self.obstacles = Obstacles(width, height, segments, circles, margin=self.obstacles.margin)
+        self.mesh = None
+        if self.events is not None:
+            self.events.resize(width, height)
+        self.update_gas()
+
+    def update_gas(self):
+        # После изменения состава газа или ящика: поле на сетке, очередь событий и опорная энергия
+        if self.gas_charge != 0 and self.count > 0 and self.engine != Engine.LANGEVIN:
+            if self.mesh is None:
+                self.mesh = ParticleMesh(self.max_width, self.max_height, self.mesh_spacing, self.r, periodic=self.periodic)
+            self.gas_charges = self.gas_charge * np.where(self.ids % 2 == 0, 1.0, -1.0)
+            self.update_mesh(0)
+        else:
+            self.mesh = None
+            self.mesh_field = None
+        if self.engine == Engine.EVENT:
+            # Очередь правится на месте в add_particles, remove_particles и resize;
+            # заново она строится, только когда газ появляется или исчезает
+            if self.count == 0:
+                self.events = None
+            elif self.events is None:
+                self.events = EventQueue(self.entities, self.radius, self.max_width, self.max_height, periodic=self.periodic, cell_size=self.get_cell_size())
+        self.reset_energy()
+
+    def get_free_positions(self, number):
+        # number точек, не перекрывающихся с газом, зарядами, препятствиями и друг с другом
+        charges = self.get_charge_positions().reshape(2 * self.n_dipoles, 2)
+        lower = np.array([self.radius, self.radius])
+        upper = np.array([self.max_width - self.radius, self.max_height - self.radius])
+        placed = np.zeros((0, 2))
+        for attempt in range(64):
+            points = np.random.uniform(lower, upper, (2 * (number - len(placed)) + 16, 2))
+            free = np.ones(len(points), dtype=bool)
+            if self.count > 0:
+                free[get_cross_pairs(points, self.entities, 2 * self.radius, self.max_width, self.max_height, 2 * self.radius, periodic=self.periodic)[0]] = False
+            reach = self.radius + self.d_radius
+            free[get_cross_pairs(points, charges, reach, self.max_width, self.max_height, reach, periodic=self.periodic)[0]] = False
+            if self.obstacles is not None:
+                free[self.obstacles.get_contacts(points, self.radius)[0]] = False
+            points = np.vstack((placed, points[free]))
+            # Из перекрывающихся между собой новых точек остаётся более ранняя
+            first, second = get_cell_pairs(points, 2 * self.radius, self.max_width, self.max_height, max_dist=2 * self.radius, periodic=self.periodic)
+            free = np.ones(len(points), dtype=bool)
+            while len(first) > 0:
+                # Пары (i, j), i < j: сначала снимаются j тех пар, у которых i сама не снята
+                drop = np.unique(second[free[first]])
+                free[drop] = False
+                keep = free[first] & free[second]
+                first = first[keep]
+                second = second[keep]
+            placed = points[free][:number]
+            if len(placed) == number:
+                return placed
+        raise ValueError(f"Cannot place {number} more particles of radius {self.radius} without overlaps")
 
-    
     def get_average_speed(self) -> float:
         if self.count == 0:
             return 0
-        return np.sqrt(self.entities[:, 2] ** 2 + self.entities[:, 3] ** 2).mean()
-    
-    def update_dipole_pair(self, dt, forced=False):
+        if self.engine == Engine.LANGEVIN:
+            return self.avg_vel
+        return np.sqrt(self.entities[:, 2] ** 2 + self.entities[:, 3] ** 2).mean(dtype=np.float64)
+
+    def __setstate__(self, state):
+        # Копия системы (deepcopy, pickle) получает отдельные массивы на месте представлений:
+        # представления состояния диполей, газа в буфере и газа очереди событий связываются заново
+        self.__dict__.update(state)
+        self.d_pos, self.d_angle, self.d_vel, self.d_w = get_state_views(self.state)
+        self.entities = self.buffer[:len(self.entities)]
+        if self.events is not None:
+            self.events.entities = self.entities
+
+    def allocate_dipoles(self):
+        # Состояние всех диполей - один вектор [положения, углы, скорости, угловые скорости];
+        # d_pos, d_angle, d_vel, d_w - его представления, их можно менять только на месте
+        n = self.n_dipoles
+        self.state = np.zeros(6 * n)
+        self.d_pos, self.d_angle, self.d_vel, self.d_w = get_state_views(self.state)
+
+        # Заранее выделенные буферы для стадий интегратора и вычисления сил
+        self.stages = np.zeros((7, 6 * n))
+        self.stage_state = np.zeros(6 * n)
+        self.next_state = np.zeros(6 * n)
+        self.error_buffer = np.zeros(6 * n)
+        self.step_size = None
+        self.verlet_positions = None
+        self.trig_buffer = np.zeros((2, n))
+        self.charges_buffer = np.zeros((n, 2, 2))
+        self.forces_buffer = np.zeros((n, 2, 2))
+        self.arm_buffer = np.zeros((n, 2))
+        self.kernels.allocate(n)
+
+    def get_charge_positions(self):
+        return get_charge_positions(self.d_pos, self.d_angle, self.r)
+
+    def reorder_entities(self):
+        # Строки entities и всё, что к ним привязано, переставляются на месте
+        order = get_morton_order(self.entities, 2 * self.radius, self.max_width, self.max_height)
+        self.entities[:] = self.entities[order]
+        self.ids = self.ids[order]
+        if self.mesh is not None:
+            self.gas_charges = self.gas_charges[order]
+        if self.engine == Engine.EVENT:
+            self.events.permute(order)
+
+    def get_cell_size(self):
+        return max(self.cell_size, 2 * self.radius)
+
+    def unwrap(self, diff):
+        # В периодическом ящике разности координат берутся до ближайшего образа
+        if self.periodic:
+            return get_min_image(diff, self.max_width, self.max_height)
+        return diff
+
+    def get_clusters(self):
+        return get_clusters(self.cluster)
+
+    def get_body(self, k):
+        # Твёрдое тело, которому передаётся удар по диполю k: сам диполь или весь его кластер.
+        # Возвращает номера диполей тела, их плечи от центра масс тела, плечо центра диполя k,
+        # массу тела и его момент инерции относительно центра масс
+        mass = 2 * self.charge_mass
+        inertial = self.charge_mass * ((4 * (self.d_radius ** 2) / 5) + (2 * (self.r ** 2)))
+        if self.d_state[k] != DipoleState.STUCK.value:
+            return np.array([k]), np.zeros((1, 2)), np.zeros(2), mass, inertial
+        members = np.flatnonzero(self.cluster == self.cluster[k])
+        offsets = self.unwrap(self.d_pos[members] - self.d_pos[k])
+        center = offsets.mean(axis=0)
+        arms = offsets - center
+        return members, arms, -center, mass * len(members), np.sum(inertial + mass * np.sum(arms ** 2, axis=1))
+
+    def update_sticking(self):
+        # Связи между диполями (см. get_sticking). Кандидаты - диполи с центрами в соседних клетках сетки.
+        # Связанные диполи объединяются в кластеры, каждый кластер - твёрдое тело.
+        first, second = get_cell_pairs(self.d_pos, 2 * self.r + MIN_DIST, self.max_width, self.max_height, periodic=self.periodic)
+        box = (self.max_width, self.max_height) if self.periodic else None
+        self.bonds, self.cluster[:], stuck = get_sticking(self.get_charge_positions(), first, second, self.bonds, box)
+        self.d_state[:] = np.where(stuck, DipoleState.STUCK.value, DipoleState.NORMAL.value)
+
+    def update_dipoles(self, dt, forced=False):
         if not forced:
-            # Рассчитываем текущее расстояние между двумя диполями
-            pairs = [(0, 2), (0, 3), (1, 2), (1, 3)]
-            r_sizes = []
-            stucks_neg = []
-            stucks_pos = []
-            for pair in pairs:
-                if pair[0] % 2 == 0:
-                    pos0 = self.dipoles[pair[0] // 2].pos + self.r * np.array([math.cos(self.dipoles[pair[0] // 2].actangle), math.sin(self.dipoles[pair[0] // 2].actangle)])
-                else:
-                    pos0 = self.dipoles[pair[0] // 2].pos - self.r * np.array([math.cos(self.dipoles[pair[0] // 2].actangle), math.sin(self.dipoles[pair[0] // 2].actangle)])
-                if pair[1] % 2 == 0:
-                    pos1 = self.dipoles[pair[1] // 2].pos + self.r * np.array([math.cos(self.dipoles[pair[1] // 2].actangle), math.sin(self.dipoles[pair[1] // 2].actangle)])
-                else:
-                    pos1 = self.dipoles[pair[1] // 2].pos - self.r * np.array([math.cos(self.dipoles[pair[1] // 2].actangle), math.sin(self.dipoles[pair[1] // 2].actangle)])
-                r = pos0 - pos1
-                r_size = np.sqrt(r[0] ** 2 + r[1] ** 2).item()
-                r_sizes.append(r_size)
-                if abs(pair[0] - pair[1]) % 2 == 0:
-                    stucks_neg.append(r_size)
-                else:
-                    stucks_pos.append(r_size)
-            distance = min(r_sizes)
-            stucks_pos = [dist for dist in stucks_pos if (dist == distance)]
-            stucks_neg = [dist for dist in stucks_neg if (dist == distance)]
-
-            # Условие для слипания: если диполи достаточно близко и оба в состоянии NORMAL
-            if self.dipoles[0].state == DipoleState.NORMAL and self.dipoles[1].state == DipoleState.NORMAL:
-                if distance <= MIN_DIST:
-                    if len(stucks_pos) > 0:
-                # Переключаем оба диполя на состояние STUCK
-                        self.dipoles[0].state = DipoleState.STUCK
-                        self.dipoles[1].state = DipoleState.STUCK
-
-                        # Вычисляем общую скорость и угловую скорость для движения как единого объекта
-                        center_velocity = (self.dipoles[0].c_vel + self.dipoles[1].c_vel) / 2
-                        self.dipoles[0].c_vel = center_velocity 
-                        self.dipoles[1].c_vel = center_velocity  # Присваиваем общую скорость
-                        angular_velocity = (self.dipoles[0].w + self.dipoles[1].w) / 2
-                        self.dipoles[0].w = angular_velocity
-                        self.dipoles[1].w = angular_velocity  # Присваиваем общую угловую скорость
-
-            # Условие для разлипания: если слипшиеся диполи разошлись дальше порога разлипания
-            elif self.dipoles[0].state == DipoleState.STUCK and self.dipoles[1].state == DipoleState.STUCK:
-                if distance > MIN_DIST or len(stucks_neg) > 0:
-                    # Переключаем оба диполя обратно на состояние NORMAL
-                    self.dipoles[0].state = DipoleState.NORMAL
-                    self.dipoles[1].state = DipoleState.NORMAL
-                else:
-                    center_velocity = (self.dipoles[0].c_vel + self.dipoles[1].c_vel) / 2
-                    self.dipoles[0].c_vel = center_velocity 
-                    self.dipoles[1].c_vel = center_velocity  # Присваиваем общую скорость
-                    angular_velocity = (self.dipoles[0].w + self.dipoles[1].w) / 2
-                    self.dipoles[0].w = angular_velocity
-                    self.dipoles[1].w = angular_velocity  # Присваиваем общую угловую скорость
-                
-        if self.dipoles[0].state == DipoleState.NORMAL:
-            self.runge_knuta_4(dt)
-        else:
-            center = (self.dipoles[0].pos + self.dipoles[1].pos) / 2 
-            self.dipoles[0].actangle += self.dipoles[0].w * dt
-            self.dipoles[1].actangle += self.dipoles[1].w * dt
-            dact = self.dipoles[0].w * dt
-            for i in range(2):
-                diff = self.dipoles[i].pos - center
-                rotation_matrix = np.array([[math.cos(dact), -math.sin(dact)],
-                                 [math.sin(dact), math.cos(dact)]])
-                self.dipoles[i].pos = center + (rotation_matrix @ diff)
-
-            self.dipoles[0].pos += self.dipoles[0].c_vel * dt
-            self.dipoles[1].pos += self.dipoles[1].c_vel * dt
+            self.update_sticking()
+        stuck, body = self.get_clusters()
+        if len(stuck) == 0:
+            self.integrate(dt)
+            return
+        rates = self.derivatives(self.state, self.stages[0])
+        mass = 2 * self.charge_mass
+        inertial = self.charge_mass * ((4 * (self.d_radius ** 2) / 5) + (2 * (self.r ** 2)))
+        box = (self.max_width, self.max_height) if self.periodic else None
+        update_clusters(self.state, rates, stuck, body, self.integrate, dt, mass, inertial, box)
 
     def set_average_speed(self, value: float) -> None:
         if self.count == 0:
             return None
+        if self.engine == Engine.LANGEVIN:
+            self.avg_vel = value
+            self.gas_energy = self.get_full_particles_energy()
+            return
         if value < 1e-3:
             self.entities[:, 2] = 0
             self.entities[:, 3] = 0
+            self.gas_energy = 0
+            if self.engine == Engine.EVENT:
+                self.events.reset()
             return
         average_speed = self.get_average_speed()
         if average_speed < 1e-3:
@@ -211,275 +747,442 @@ class ParticleSystem:
             return
         self.entities[:, 2] *= (value / average_speed)
         self.entities[:, 3] *= (value / average_speed)
+        self.gas_energy *= (value / average_speed) ** 2
+        if self.engine == Engine.EVENT:
+            self.events.rescale(value / average_speed)
+
+    def reset_energy(self):
+        # Текущая энергия становится опорной для перемасштабирования скоростей
+        self.full = self.get_full_potential() + self.get_full_kinetic()
+        self.gas_energy = self.get_full_particles_energy()
+        self.full_p = self.gas_energy
+
+    def get_kinetics(self):
+        # Кинетическая энергия каждого диполя; скорости слипшихся включают вращение кластера,
+        # так что сумма по кластеру равна энергии твёрдого тела
+        return get_kinetic(self.d_vel, self.d_w, mass=self.charge_mass, d_radius=self.d_radius, r=self.r)
 
     def get_full_kinetic(self):
-        if self.dipoles[0].state == DipoleState.NORMAL:
-            center = None
-        else:
-            center = (self.dipoles[0].pos + self.dipoles[1].pos) / 2
-        return sum([get_kinetic(self.dipoles[i], mass=self.charge_mass, d_radius=self.d_radius, r=self.r, center=center) for i in range(2)])
+        return np.sum(self.get_kinetics())
 
     def get_full_potential(self):
-        p1_1, p1_2 = self.dipoles[0].get_positions()
-        p2_1, p2_2 = self.dipoles[1].get_positions()
-        p1 = self.charge * (p1_1 - p1_2)
-        p2 = self.charge * (p2_1 - p2_2)
-        r = self.dipoles[0].pos - self.dipoles[1].pos
-        r_size = np.linalg.norm(r).item()
-        return K * ((p1 @ p2) * (r_size ** 2) - 3 * (p1 @ r) * (p2 @ r)) / ((r_size + self.r) ** 5)
-    
+        if self.mesh is not None:
+            return self.get_dipoles_potential() + self.get_mesh_energy()
+        return self.get_dipoles_potential()
+
+    def get_dipoles_potential(self):
+        if self.periodic:
+            n = self.n_dipoles
+            points = self.get_charge_positions().reshape(2 * n, 2)
+            return self.ewald.get_energy(points, self.charge * np.tile([1.0, -1.0], n), self.r, K)
+        if self.theta > 0 and self.n_dipoles >= self.tree_min_dipoles:
+            # Силы считаются по дереву, энергия - тем же обходом дерева, а не по всем парам
+            return get_tree_potential(self.get_charge_positions(), self.charge, self.r, self.theta, K)
+        if self.integrator in SYMPLECTIC_WEIGHTS:
+            return get_charge_potential(self.get_charge_positions(), self.charge, self.r)
+        return get_dipole_potential(self.d_pos, self.d_angle, self.r, self.charge, self.r)
+
+    def get_bath(self):
+        # Трение и температура неявного газа. Поток молекул идеального двумерного газа
+        # (плотность n, средняя скорость v) на диск радиуса R = radius + d_radius при зеркальном
+        # отражении даёт силу трения 4 R n m v на единицу скорости; kT = 2 m v^2 / pi
+        density = self.count / (self.max_width * self.max_height)
+        friction = 4 * (self.radius + self.d_radius) * density * self.m * self.avg_vel
+        temperature = 2 * self.m * self.avg_vel ** 2 / math.pi
+        return friction, temperature
+
+    def apply_bath(self, dt):
+        # Точное решение уравнения Орнштейна-Уленбека за шаг: затухание скоростей и случайный толчок,
+        # согласованный с затуханием (флуктуационно-диссипационная теорема).
+        # Оба заряда тормозятся газом: поступательное трение 2 * zeta, вращательное 2 * zeta * r^2
+        n = self.n_dipoles
+        friction, temperature = self.get_bath()
+        mass = 2 * self.charge_mass
+        inertial = self.charge_mass * ((4 * (self.d_radius ** 2) / 5) + (2 * (self.r ** 2)))
+        decay = math.exp(-2 * friction / mass * dt)
+        self.d_vel *= decay
+        self.d_vel += math.sqrt(temperature / mass * (1 - decay ** 2)) * np.random.normal(size=(n, 2))
+        decay = math.exp(-2 * friction * self.r ** 2 / inertial * dt)
+        self.d_w *= decay
+        self.d_w += math.sqrt(temperature / inertial * (1 - decay ** 2)) * np.random.normal(size=n)
+
+    def update_mesh(self, dt):
+        # Поле газа и диполей на сетке: молекулы получают толчок от полного поля,
+        # поле одного газа запоминается для сил на заряды диполей на всех стадиях интегратора
+        n = self.n_dipoles
+        gas = self.mesh.get_weights(self.entities[:, 0:2])
+        charges = self.mesh.get_weights(self.get_charge_positions().reshape(2 * n, 2))
+        gas_density = self.mesh.deposit(gas, self.gas_charges)
+        gas_potential = self.mesh.solve(gas_density)
+        dipole_potential = self.mesh.solve(self.mesh.deposit(charges, self.charge * np.tile([1.0, -1.0], n)))
+        self.mesh_potential = gas_potential
+        self.mesh_field = np.stack(self.mesh.get_field(gas_potential))
+        # Интерполяция - транспонированная раскладка, поэтому энергию газа можно считать прямо на сетке
+        self.gas_self_energy = np.sum(gas_density * gas_potential) / 2
+        if dt == 0:
+            return
+        ex, ey = self.mesh.gather(np.stack(self.mesh.get_field(gas_potential + dipole_potential)), gas)
+        coef = K * self.gas_charges * dt / self.m
+        self.entities[:, 2] += coef * ex
+        self.entities[:, 3] += coef * ey
+        self.gas_energy = self.get_full_particles_energy()
+        if self.engine == Engine.EVENT:
+            # Поле меняет скорости всех молекул, предсказанные события устаревают
+            self.events.reset()
+
+    def get_mesh_energy(self):
+        # Энергия газа в собственном поле и в поле диполей (по зарядам диполей в поле газа)
+        n = self.n_dipoles
+        charges = self.mesh.get_weights(self.get_charge_positions().reshape(2 * n, 2))
+        dipoles = np.sum(self.charge * np.tile([1.0, -1.0], n) * self.mesh.gather(self.mesh_potential, charges))
+        return K * (self.gas_self_energy + dipoles)
+
+    def add_mesh_forces(self, charges, forces):
+        # Силы поля газа на заряды диполей: (M, 2, 2) -> добавляются к forces
+        n = self.n_dipoles
+        stencil = self.mesh.get_weights(charges.reshape(2 * n, 2))
+        q = K * self.charge * np.tile([1.0, -1.0], n)
+        forces.reshape(2 * n, 2)[:] += (q * self.mesh.gather(self.mesh_field, stencil)).T
+
     def get_full_particles_energy(self):
         if self.count == 0:
             return 0
-        return self.m * np.sum(self.entities[:, 2] ** 2 + self.entities[:, 3] ** 2) / 2
-    
+        if self.engine == Engine.LANGEVIN:
+            # Энергия неявного газа: kT на молекулу (две степени свободы)
+            return self.count * self.get_bath()[1]
+        return get_gas_energy(self.entities[:, 2:4], self.m)
+
     def get_full_energy(self):
         return self.get_full_kinetic() + self.get_full_potential() + self.get_full_particles_energy()
-    
-    def force(self, q1, q2, r):
-        return K * q1 * q2 * r / (np.linalg.norm(r).item() + self.r) ** 3
-    
-    def derivatives(self, dipole1: Dipole, dipole2: Dipole, dt):
-        p1_1, p1_2 = dipole1.get_positions()
-        p2_1, p2_2 = dipole2.get_positions()
 
-        f11 = self.force(self.charge, self.charge, p1_1 - p2_1)
-        f12 = self.force(self.charge, -self.charge, p1_1 - p2_2)
-        f21 = self.force(-self.charge, self.charge, p1_2 - p2_1)
-        f22 = self.force(-self.charge, -self.charge, p1_2 - p2_2)
+    def get_forces(self, charges):
+        # Силы между зарядами без выделения памяти: все промежуточные массивы - буферы
+        if self.periodic:
+            n = self.n_dipoles
+            points = charges.reshape(2 * n, 2)
+            q = self.charge * np.tile([1.0, -1.0], n)
+            self.forces_buffer.reshape(2 * n, 2)[:] = self.ewald.get_forces(points, q, self.r, K)
+            return self.forces_buffer
+        if self.theta > 0 and self.n_dipoles >= self.tree_min_dipoles:
+            self.forces_buffer[:] = get_tree_forces(charges, self.charge, self.r, self.theta, K)
+            return self.forces_buffer
+        n = self.n_dipoles
+        forces = self.kernels.get_forces(charges.reshape(2 * n, 2), self.r, self.forces_buffer.reshape(2 * n, 2))
+        forces *= K * (self.charge ** 2)
+        return self.forces_buffer
+
+    def derivatives(self, y, out):
+        # Правая часть уравнений движения для вектора состояния y, результат пишется в out
+        n = self.n_dipoles
+        cos, sin = self.trig_buffer
+        np.cos(y[2 * n:3 * n], out=cos)
+        np.sin(y[2 * n:3 * n], out=sin)
+        arm = self.arm_buffer
+        np.multiply(cos, self.r, out=arm[:, 0])
+        np.multiply(sin, self.r, out=arm[:, 1])
+        charges = self.charges_buffer
+        np.add(y[0:2 * n].reshape(n, 2), arm, out=charges[:, 0])
+        np.subtract(y[0:2 * n].reshape(n, 2), arm, out=charges[:, 1])
+        forces = self.get_forces(charges)
+        if self.mesh_field is not None:
+            self.add_mesh_forces(charges, forces)
+
+        out[0:3 * n] = y[3 * n:6 * n]
+        dvel = out[3 * n:5 * n].reshape(n, 2)
+        np.add(forces[:, 0], forces[:, 1], out=dvel)
+        dvel *= 1 / (2 * self.charge_mass)
 
-        dpos1 = dt * dipole1.c_vel
-        dpos2 = dt * dipole2.c_vel
+        # Момент сил: заряды стоят на плечах +arm и -arm
+        moment = out[5 * n:6 * n]
+        np.subtract(forces[:, 0], forces[:, 1], out=charges[:, 0])
+        np.multiply(arm[:, 0], charges[:, 0, 1], out=moment)
+        np.multiply(arm[:, 1], charges[:, 0, 0], out=cos)
+        moment -= cos
+        inertial = self.charge_mass * ((4 * (self.d_radius ** 2) / 5) + (2 * (self.r ** 2)))
+        moment *= 1 / inertial
+        return out
 
-        dact1 = dt * dipole1.w
-        dact2 = dt * dipole2.w
+    def runge_knuta_4(self, dt):
+        runge_knuta_4(self.derivatives, self.state, self.stages, self.stage_state, dt)
 
-        dvel1 = dt * (f11 + f12 + f21 + f22) / (2 * self.charge_mass)
-        dvel2 = -dt * (f11 + f12 + f21 + f22) / (2 * self.charge_mass)
+    def dormand_prince(self, dt):
+        # Адаптивный шаг: за время dt делается столько шагов, сколько требует оценка ошибки.
+        # Предложенный шаг сохраняется между вызовами, так что при h >= dt шаг ровно один.
+        y = self.state
+        stages = self.stages
+        stage = self.stage_state
+        y_new = self.next_state
+        error = self.error_buffer
+        h = dt if self.step_size is None else self.step_size
+        t = 0.0
+        self.derivatives(y, stages[0])
+        while t < dt * (1 - 1e-12):
+            step = min(h, dt - t)
+            for i, a in enumerate(DOPRI_A):
+                np.dot(a, stages[:i + 1], out=stage)
+                stage *= step
+                stage += y
+                if i < len(DOPRI_A) - 1:
+                    self.derivatives(stage, stages[i + 1])
+            y_new[:] = stage
+            self.derivatives(y_new, stages[6])
 
-        moment1 = np.cross(p1_1 - dipole1.pos, f11 + f12) + np.cross(p1_2 - dipole1.pos, f21 + f22)
-        moment2 = -np.cross(p2_1 - dipole2.pos, f11 + f21) - np.cross(p2_2 - dipole2.pos, f22 + f12)
+            np.dot(DOPRI_E, stages, out=error)
+            error *= step
+            np.maximum(np.abs(y), np.abs(y_new), out=stage)
+            stage *= self.rtol
+            stage += self.atol
+            error /= stage
+            norm = math.sqrt(np.mean(error ** 2))
+            factor = min(5.0, max(0.2, 0.9 * (norm + EPS) ** -0.2))
+            if norm <= 1:
+                t += step
+                y[:] = y_new
+                stages[0] = stages[6]
+                # Укороченный последний шаг не должен уменьшать предложенный шаг
+                h = max(h, step * factor) if step < h else step * factor
+            else:
+                h = step * factor
+        self.step_size = h
 
-        inertial1 = self.charge_mass * ((4 * (self.d_radius ** 2) / 5) + (2 * (self.r ** 2)))
-        inertial2 = self.charge_mass * ((4 * (self.d_radius ** 2) / 5) + (2 * (self.r ** 2)))
+    def velocity_verlet(self, dt):
+        # Полушаг скоростей, сдвиг положений и углов (свободный ротатор), ещё полушаг скоростей.
+        # Ускорения зависят только от положений, поэтому с прошлого шага они берутся повторно,
+        # если положения с тех пор не менялись (удары о стенки их сдвигают).
+        n = self.n_dipoles
+        y = self.state
+        accel = self.stages[0]
+        half = self.stage_state[3 * n:6 * n]
+        if self.verlet_positions is None or not np.array_equal(self.verlet_positions, y[0:3 * n]):
+            self.derivatives(y, accel)
+        np.multiply(accel[3 * n:6 * n], dt / 2, out=half)
+        y[3 * n:6 * n] += half
+        np.multiply(y[3 * n:6 * n], dt, out=self.stage_state[0:3 * n])
+        y[0:3 * n] += self.stage_state[0:3 * n]
+        self.derivatives(y, accel)
+        np.multiply(accel[3 * n:6 * n], dt / 2, out=half)
+        y[3 * n:6 * n] += half
+        if self.verlet_positions is None:
+            self.verlet_positions = np.zeros(3 * n)
+        self.verlet_positions[:] = y[0:3 * n]
 
-        e1 = moment1 / inertial1
-        e2 = moment2 / inertial2
+    def integrate(self, dt):
+        if self.integrator == Integrator.DOPRI5:
+            self.dormand_prince(dt)
+        elif self.integrator in SYMPLECTIC_WEIGHTS:
+            for weight in SYMPLECTIC_WEIGHTS[self.integrator]:
+                self.velocity_verlet(weight * dt)
+        else:
+            self.runge_knuta_4(dt)
 
-        dw1 = dt * e1
-        dw2 = dt * e2
+    def get_substeps(self, dt):
+        if self.substeps > 0:
+            return self.substeps
+        return get_substeps(self.state, self.derivatives(self.state, self.stages[0]), self.r, dt)
 
-        return [Dipole(pos=dpos1, r=self.r, actangle=dact1, c_vel=dvel1, w=dw1), Dipole(dpos2, self.r, dact2, dvel2, dw2)]
-    
-    def runge_knuta_4(self, dt):
-        k1 = self.derivatives(self.dipoles[0], self.dipoles[1], dt)
-        k2 = self.derivatives(self.dipoles[0] + k1[0] / 2, self.dipoles[1] + k1[1] / 2, dt / 2)
-        k3 = self.derivatives(self.dipoles[0] + k2[0] / 2, self.dipoles[1] + k2[1] / 2, dt / 2)
-        k4 = self.derivatives(self.dipoles[0] + k3[0], self.dipoles[1] + k3[1], dt)
-        self.dipoles[0] = self.dipoles[0] + (k1[0] / 6) + (k2[0] / 3) + (k3[0] / 3) + (k4[0] / 6)
-        self.dipoles[1] = self.dipoles[1] + (k1[1] / 6) + (k2[1] / 3) + (k3[1] / 3) + (k4[1] / 6)
-
-    
-    def proceed(self, dt: float):
-        self.dv = np.array([[0, 0], [0, 0]])
-        self.dw = np.array([0, 0])
+    def reflect_dipoles(self):
+        # Отражение зарядов от стенок; весь кластер слипшихся диполей сдвигается и отражается вместе.
+        # В периодическом ящике центры диполей просто возвращаются в ящик.
+        if self.obstacles is not None:
+            self.reflect_obstacles()
+        if self.periodic:
+            self.d_pos[:, 0] %= self.max_width
+            self.d_pos[:, 1] %= self.max_height
+            return
+        reflect_walls(self.state, self.cluster, self.r, self.max_width, self.max_height)
+
+    def reflect_obstacles(self):
+        # Упругий удар заряда о неподвижное препятствие: импульс вдоль нормали с учётом
+        # массы и момента инерции диполя. Диполь (или весь его кластер) выталкивается наружу
+        # на глубину самого глубокого касания.
+        points = self.get_charge_positions().reshape(2 * self.n_dipoles, 2)
+        index, normal, depth = self.obstacles.get_contacts(points, self.d_radius)
+        if len(index) == 0:
+            return
+        labels = self.cluster
+        shift = np.zeros((self.n_dipoles, 2))
+        for i in np.argsort(depth):
+            k = index[i] // 2
+            arm = points[index[i]] - self.d_pos[k]
+            c_vel = self.d_vel[k] + self.d_w[k] * np.array([-arm[1], arm[0]])
+            approach = np.dot(c_vel, normal[i])
+            if approach < 0:
+                members, arms, center_arm, mass, inertial = self.get_body(k)
+                lever = cross(arm + center_arm, normal[i])
+                impulse = -2 * approach / (1 / mass + lever ** 2 / inertial)
+                dw = impulse * lever / inertial
+                self.d_vel[members] += normal[i] * impulse / mass + dw * np.stack((-arms[:, 1], arms[:, 0]), axis=-1)
+                self.d_w[members] += dw
+            shift[labels[k]] = normal[i] * depth[i]
+        self.d_pos += shift[labels]
+
+    def collide_gas(self):
+        # Удары молекул газа о заряды диполей в конце шага; возвращает номера молекул, получивших удар
+        touched = []
+        charges = self.get_charge_positions()
+        velocities = get_charge_velocities(self.d_vel, self.d_angle, self.d_w, self.r)
+        owners, index = self.kernels.get_contacts(self.entities, charges.reshape(2 * self.n_dipoles, 2), self.radius + self.d_radius, self.max_width, self.max_height, self.periodic)
+        bounds = np.flatnonzero(np.diff(owners)) + 1
+        for group in np.split(np.arange(len(owners)), bounds) if len(owners) > 0 else []:
+            i = owners[group[0]]
+            k = i // 2
+            pos = charges[k, i % 2]
+            arm = pos - self.d_pos[k]
+            if self.integrator in SYMPLECTIC_WEIGHTS:
+                c_vel = self.get_contact_velocity(k, arm)
+            else:
+                c_vel = velocities[k, i % 2]
+            touched.append(self.apply_impulses(k, pos, arm, c_vel, index[group]))
+        return touched
+
+    def sweep_gas(self, dt):
+        # Непрерывная проверка ударов за весь шаг: путь заряда (перенос и вращение) разбивается
+        # на отрезки, на каждом ищется момент касания с равномерно летящей молекулой.
+        # Удары обрабатываются по времени, каждая молекула - не больше одного раза за шаг.
+        arr = self.entities
+        reach = self.radius + self.d_radius
+        gas_speed = math.sqrt(np.max(arr[:, 2] ** 2 + arr[:, 3] ** 2))
+        segments = min(max(math.ceil(np.max(np.abs(self.d_w)) * dt / SWEEP_ANGLE), 1), MAX_SWEEP_SEGMENTS)
+        times = np.linspace(0, dt, segments + 1)
+        length = dt / segments
+        hits = []
+        for k in range(self.n_dipoles):
+            limit = self.r + reach + (gas_speed + math.sqrt(np.sum(self.d_vel[k] ** 2))) * dt
+            offsets = self.unwrap(arr[:, 0:2] - self.d_pos[k])
+            index = np.flatnonzero(np.sum(offsets ** 2, axis=1) < limit ** 2)
+            if len(index) == 0:
+                continue
+            charges = get_charge_positions(self.d_pos[k] + self.d_vel[k] * times[:, np.newaxis], self.d_angle[k] + self.d_w[k] * times, self.r)
+            gas = (self.d_pos[k] + offsets[index])[:, np.newaxis, :] + arr[index, np.newaxis, 2:4] * times[:, np.newaxis]
+            # Относительное движение на каждом отрезке считается равномерным: (молекулы, отрезки, заряды, 2)
+            diff = gas[:, :, np.newaxis, :] - charges[np.newaxis]
+            start = diff[:, :-1]
+            rel = (diff[:, 1:] - start) / length
+            a = np.sum(rel ** 2, axis=-1)
+            b = np.sum(start * rel, axis=-1)
+            c = np.sum(start ** 2, axis=-1) - reach ** 2
+            disc = b * b - a * c
+            root = np.where(c <= 0, 0.0, (-b - np.sqrt(np.maximum(disc, 0))) / np.maximum(a, EPS))
+            ok = (b < 0) & (disc >= 0) & (root <= length)
+            toi = np.where(ok, times[:-1, np.newaxis] + root, np.inf).min(axis=1)
+            first, charge = np.nonzero(np.isfinite(toi))
+            hits.extend(zip(toi[first, charge], [k] * len(first), charge, index[first]))
+
+        touched = []
+        done = set()
+        for t, k, charge, j in sorted(hits):
+            if j in done:
+                continue
+            center = self.d_pos[k] + self.d_vel[k] * t
+            pos = get_charge_positions(center, self.d_angle[k] + self.d_w[k] * t, self.r)[charge]
+            arm = pos - center
+            # Молекула ставится в точку касания, а после удара - туда, откуда она с новой
+            # скоростью к концу шага придёт в ту же точку, что и после удара в момент t
+            arr[j, 0:2] += arr[j, 2:4] * t
+            hit = self.apply_impulses(k, pos, arm, self.get_contact_velocity(k, arm), np.array([j]))
+            arr[j, 0:2] -= arr[j, 2:4] * t
+            if len(hit) > 0:
+                done.add(j)
+                touched.append(hit)
+        return touched
+
+    def get_contact_velocity(self, k, arm):
+        # Скорость точки диполя k на плече arm с учётом уже полученных на этом шаге ударов
+        w = self.d_w[k] + self.dw[k]
+        return self.d_vel[k] + self.dv[k] + w * np.array([-arm[1], arm[0]])
+
+    def apply_impulses(self, k, pos, arm, c_vel, index):
+        # Удары молекул index о заряд диполя k в точке pos (плечо arm, скорость c_vel);
+        # возвращает номера молекул, которые действительно получили удар
+        arr = self.entities
+        before = get_gas_energy(arr[index, 2:4], self.m)
+        if self.integrator in SYMPLECTIC_WEIGHTS:
+            hit = self.collide_elastic(k, pos, arm, c_vel, index)
+        else:
+            box = (self.max_width, self.max_height) if self.periodic else None
+            mask, dv, dw = hit_charges(arr, index, np.zeros(len(index), dtype=np.int64), pos[np.newaxis], arm[np.newaxis], c_vel[np.newaxis],
+                                       self.m, self.charge_mass, self.d_radius, self.r, box)
+            hit = index[mask]
+            self.dv[k] += dv[0]
+            self.dw[k] += dw[0]
+        change = get_gas_energy(arr[index, 2:4], self.m) - before
+        self.gas_energy += change
+        self.impulse_energy += change
+        return hit
+
+    def collide_elastic(self, k, pos, arm, c_vel, index):
+        # Абсолютно упругий удар молекулы о заряд диполя как о точку твёрдого тела:
+        # импульс вдоль нормали с учётом массы и момента инерции диполя, энергия сохраняется.
+        # Одновременные удары применяются по очереди, скорость заряда после каждого обновляется.
+        # Удар по слипшемуся диполю получает весь кластер: масса, момент инерции и плечо - кластера
+        members, arms, center_arm, mass, inertial = self.get_body(k)
+        hit, dv, dw = self.kernels.collide_elastic(self.entities, index, pos, arm + center_arm, c_vel, self.m, mass, inertial, self.max_width, self.max_height, self.periodic)
+        self.dv[members] += dv + dw * np.stack((-arms[:, 1], arms[:, 0]), axis=-1)
+        self.dw[members] += dw
+        return index[hit]
+
+    def begin_step(self):
+        # Начало шага: обнуление ударов, учёт изменённых параметров; возвращает forced для update_dipoles
+        self.dv = np.zeros((self.n_dipoles, 2))
+        self.dw = np.zeros(self.n_dipoles)
+        self.impulse_energy = 0.0
         forced = False
         if self.prev_charge != self.charge or self.prev_m != self.m or self.prev_charge_mass != self.charge_mass:
-            self.full = self.get_full_potential() + self.get_full_kinetic()
-            self.full_p = self.get_full_particles_energy()
+            self.reset_energy()
             self.prev_charge = self.charge
             self.prev_charge_mass = self.charge_mass
             self.prev_m = self.m
         if self.charge == 0:
-            self.dipoles[0].state = DipoleState.NORMAL
-            self.dipoles[1].state = DipoleState.NORMAL
+            self.bonds = np.empty((0, 2), dtype=np.int64)
+            self.cluster[:] = np.arange(self.n_dipoles)
+            self.d_state[:] = DipoleState.NORMAL.value
             forced = True
-        if self.count > 0:
-            self.entities[:, 0] += self.entities[:, 2] * dt
-            self.entities[:, 1] += self.entities[:, 3] * dt
-            mask = self.entities[:, 0] < 0
-            self.entities[mask, 0] = 0
-            self.entities[mask, 2] *= -1
-            mask = self.entities[:, 0] > self.max_width
-            self.entities[mask, 0] = self.max_width
-            self.entities[mask, 2] *= -1
-            mask = self.entities[:, 1] < 0
-            self.entities[mask, 1] = 0
-            self.entities[mask, 3] *= -1
-            mask = self.entities[:, 1] > self.max_height
-            self.entities[mask, 1] = self.max_height
-            self.entities[mask, 3] *= -1
-        for i in range(2):
-            #self.dipoles[i].pos += self.dipoles[i].c_vel * dt
-            #self.dipoles[i].actangle += self.dipoles[i].w * dt
-            q0 = self.dipoles[i].pos + self.r * np.array([math.cos(self.dipoles[i].actangle), math.sin(self.dipoles[i].actangle)])
-            q1 = self.dipoles[i].pos - self.r * np.array([math.cos(self.dipoles[i].actangle), math.sin(self.dipoles[i].actangle)])
-            for j, q in enumerate([q0, q1]):
-                if j == 0:
-                    w_vel = self.dipoles[i].w * np.array([-math.sin(self.dipoles[i].actangle), math.cos(self.dipoles[i].actangle)])
-                else:
-                    w_vel = -self.dipoles[i].w * np.array([-math.sin(self.dipoles[i].actangle), math.cos(self.dipoles[i].actangle)])
-                if q[0] < 0:
-                    self.dipoles[i].pos[0] -= q[0]
-                    self.dipoles[i].c_vel[0] = abs(self.dipoles[i].c_vel[0])
-                    if w_vel[0] < 0:
-                        self.dipoles[i].w *= -1
-                    if self.dipoles[i].state == DipoleState.STUCK:
-                        self.dipoles[1 - i].pos[0] -= q[0]
-                        self.dipoles[1 - i].c_vel[0] = abs(self.dipoles[1 - i].c_vel[0])
-                        if w_vel[0] < 0:
-                            self.dipoles[1 - i].w *= -1
-                if q[0] > self.max_width:
-                    self.dipoles[i].pos[0] += self.max_width - q[0]
-                    self.dipoles[i].c_vel[0] = -abs(self.dipoles[i].c_vel[0])
-                    if w_vel[0] > 0:
-                        self.dipoles[i].w *= -1
-                    if self.dipoles[i].state == DipoleState.STUCK:
-                        self.dipoles[1 - i].pos[0] += self.max_width - q[0]
-                        self.dipoles[1 - i].c_vel[0] = -abs(self.dipoles[1 - i].c_vel[0])
-                        if w_vel[0] > 0:
-                            self.dipoles[1 - i].w *= -1
-                if q[1] < 0:
-                    self.dipoles[i].pos[1] -= q[1]
-                    self.dipoles[i].c_vel[1] = abs(self.dipoles[i].c_vel[1])
-                    if w_vel[1] < 0:
-                        self.dipoles[i].w *= -1
-                    if self.dipoles[i].state == DipoleState.STUCK:
-                        self.dipoles[1 - i].pos[1] -= q[1]
-                        self.dipoles[1 - i].c_vel[1] = abs(self.dipoles[1 - i].c_vel[1])
-                        if w_vel[1] < 0:
-                            self.dipoles[1 - i].w *= -1
-                if q[1] > self.max_height:
-                    self.dipoles[i].pos[1] += self.max_height - q[1]
-                    self.dipoles[i].c_vel[1] = -abs(self.dipoles[i].c_vel[1])
-                    if w_vel[1] > 0:
-                        self.dipoles[i].w *= -1
-                    if self.dipoles[i].state == DipoleState.STUCK:
-                        self.dipoles[1 - i].pos[1] += self.max_height - q[1]
-                        self.dipoles[1 - i].c_vel[1] = -abs(self.dipoles[1 - i].c_vel[1])
-                        if w_vel[1] > 0:
-                            self.dipoles[1 - i].w *= -1
-
-        if self.count > 0:
-            for i in range(4):
-                cos = math.cos(self.dipoles[i // 2].actangle)
-                sin = math.sin(self.dipoles[i // 2].actangle)
-                if i % 2 == 0:
-                    pos = self.dipoles[i // 2].pos + self.r * np.array([cos, sin])
-                    vel = self.dipoles[i // 2].c_vel + self.dipoles[i // 2].w * np.array([-sin, cos])
-                else:
-                    pos = self.dipoles[i // 2].pos - self.r * np.array([cos, sin])
-                    vel = self.dipoles[i // 2].c_vel - self.dipoles[i // 2].w * np.array([-sin, cos])
-                charge = np.array([pos[0], pos[1], vel[0], vel[1]])
-                arr = self.entities
-                mask = (arr[:, 0] - charge[0]) ** 2 + (arr[:, 1] - charge[1]) ** 2 < ((self.radius + self.d_radius)** 2)
-                # mask = mask & (((arr[:, 0] - charge[0]) ** 2 + (arr[:, 1] - charge[1]) ** 2) != 0)
-                if len(arr[mask]) > 0:
-                    old_vx = charge[2]
-                    old_vy = charge[3]
-                    old_v = np.array([old_vx, old_vy])
-                    old_r = charge[0:2]
-                    
-                    r_diff = arr[:, 0:2] - old_r
-                    r_mag2 = r_diff[:, 0] ** 2 + r_diff[:, 1] ** 2
-                    mask = mask & (np.sum((self.m * arr[:,2:4] - self.charge_mass * old_v) * r_diff, axis=1) < 0)
-                    r_diff = r_diff[mask,:]
-                    r_mag2 = r_mag2[mask]
-
-                    scalar_dot = np.sum((self.m * arr[mask, 2:4] - self.charge_mass * old_v) * r_diff, axis=1) / r_mag2
-                    temp = r_diff.copy()
-                    temp[:, 0] *= scalar_dot
-                    temp[:, 1] *= scalar_dot
-                    arr[mask, 2:4] -= (temp / self.m)
-                    delta_v = np.sum(temp, axis=0) / self.charge_mass
-                    # self.dipoles[i // 2].c_vel += delta_v / 2
-                    self.dv[(i // 2),:] = self.dv[(i // 2),:] + (delta_v / 2)
-                    L = np.cross(pos - self.dipoles[i // 2].pos, self.charge_mass * delta_v)
-                    I = self.charge_mass * ((2 * (self.d_radius ** 2) / 5) + (1 * (self.r ** 2)))
-                    # self.dipoles[i // 2].w += L / I
-                    self.dw[i // 2] += L / I
-            for i in range(self.count):
-                arr = self.entities[i+1:]
-                mask = (arr[:, 0] - self.entities[i, 0]) ** 2 + (arr[:, 1] - self.entities[i, 1]) ** 2 < ((2 * self.radius) ** 2)
-                # mask = mask & (((arr[:, 0] - self.entities[i, 0]) ** 2 + (arr[:, 1] - self.entities[i, 1]) ** 2) != 0)
-                if len(arr[mask]) == 0:
-                    continue
-                
-                old_vx = self.entities[i, 2]
-                old_vy = self.entities[i, 3]
-                old_v = np.array([old_vx, old_vy])
-                old_r = self.entities[i, 0:2]
-
-                r_diff = arr[:, 0:2] - old_r
-                r_mag2 = r_diff[:, 0] ** 2 + r_diff[:, 1] ** 2
-                mask = mask & (np.sum((arr[:,2:4] - old_v) * r_diff, axis=1) < 0)
-                r_diff = r_diff[mask,:]
-                r_mag2 = r_mag2[mask]
-                
-                scalar_dot = np.sum((arr[mask, 2:4] - old_v) * r_diff, axis=1) / r_mag2
-                temp = r_diff.copy()
-                temp[:, 0] *= scalar_dot
-                temp[:, 1] *= scalar_dot
-                arr[mask, 2:4] -= temp
-                self.entities[i, 2:4] += np.sum(temp, axis=0)
-                
-                '''
-                old_vx = self.entities[i, 2]
-                old_vy = self.entities[i, 3]
-                old_v = np.array([old_vx, old_vy])
-                old_r = self.entities[i, 0:2]
-
-                r_diff = arr[mask, 0:2] - old_r
-                r_mag2 = r_diff[:, 0] ** 2 + r_diff[:, 1] ** 2
-                r_mag = np.sqrt(r_mag2)
-                normal = r_diff / r_mag[:, np.newaxis]
-
-                v_rel = arr[mask, 2:4] - old_v
-                v_normal = np.sum(v_rel * normal, axis=1)
-
-                # Elastic collision response
-                v_normal_new = -v_normal
-                v_tangent = v_rel - v_normal[:, np.newaxis] * normal
-
-                new_v = v_normal_new[:, np.newaxis] * normal + v_tangent
-
-                arr[mask, 2:4] -= new_v
-                self.entities[i, 2:4] += np.sum(new_v, axis=0)
-                '''
-        for i in range(2):
-            self.dipoles[i].pos += self.dv[i] * dt
-            self.dipoles[i].actangle += self.dw[i] * dt
-        self.update_dipole_pair(dt, forced=forced)
-        for i in range(2):
-            self.dipoles[i].c_vel += self.dv[i]
-            self.dipoles[i].w += self.dw[i]
-        it = 0
-        while True:
-            it += 1
-            kin_est = (self.full + self.full_p) - self.get_full_potential()
-            if self.charge > 0 or self.count > 0:
-                try:
-                    coef = math.sqrt(kin_est / (self.get_full_kinetic() + self.get_full_particles_energy()))
-                except:
-                    print(kin_est)
-                    assert False
-                for i in range(2):
-                    self.dipoles[i].c_vel *= coef
-                    self.dipoles[i].w *= coef
-                if self.count > 0:
-                    self.entities[:, 2:] *= coef
-            if abs(kin_est - self.get_full_kinetic()) < EPS or it == 5:
-                break
-        if self.dipoles[0].state == DipoleState.NORMAL:
-            center = None
-        else:
-            center = (self.dipoles[0].pos + self.dipoles[1].pos) / 2
-        '''
-        try:
-            assert abs(kin_est - self.get_full_kinetic()) < EPS
-        except:
-            print(kin_est, self.get_full_kinetic())
-            assert False
-        '''
-
-        return [get_kinetic(self.dipoles[i], mass=self.charge_mass, d_radius=self.d_radius, r=self.r, center=center) for i in range(2)] + [self.get_full_potential(), self.get_full_energy()]
\ No newline at end of file
+        return forced
+
+    def end_step(self, dt, forced, recount=True):
+        # Конец шага после газа (см. finish_step). recount=False - энергию газа уже пересчитал владелец
+        # газа (DecomposedSystem держит газ в полосах, и entities главной системы пуст)
+        gas = self.count > 0 and self.engine != Engine.LANGEVIN
+        if self.mesh is not None:
+            self.update_mesh(dt)
+        rescale = self.integrator not in SYMPLECTIC_WEIGHTS and self.engine != Engine.LANGEVIN and (self.charge > 0 or self.count > 0)
+        bath = self.apply_bath if self.engine == Engine.LANGEVIN else None
+        kinetics, potential, coef = finish_step(self, dt, forced, gas, rescale, recount, bath)
+        if rescale and gas and self.engine == Engine.EVENT:
+            self.events.rescale(coef)
+        return list(kinetics) + [potential, potential + np.sum(kinetics) + self.gas_energy]
+
+    def proceed(self, dt: float):
+        forced = self.begin_step()
+        gas = self.count > 0 and self.engine != Engine.LANGEVIN
+        self.ITERATION += 1
+        if gas and self.reorder_every > 0 and self.ITERATION % self.reorder_every == 0:
+            self.reorder_entities()
+        if gas and self.swept:
+            # Удары о диполи находятся заранее по путям молекул и зарядов за весь шаг
+            touched = self.sweep_gas(dt)
+            if self.engine == Engine.EVENT and len(touched) > 0:
+                self.events.update(np.unique(np.concatenate(touched)))
+        if gas and self.engine == Engine.EVENT:
+            # Газ продвигается от события к событию точно до момента конца шага
+            self.events.advance(self.events.time + dt)
+        elif gas:
+            self.kernels.advect(self.entities, dt, self.max_width, self.max_height, self.periodic)
+        if gas and self.obstacles is not None:
+            hit = self.obstacles.reflect(self.entities[:, 0:2], self.entities[:, 2:4], self.radius)
+            if self.engine == Engine.EVENT and len(hit) > 0:
+                self.events.update(hit)
+        self.reflect_dipoles()
+
+        if gas:
+            if not self.swept:
+                touched = self.collide_gas()
+            if self.engine == Engine.EVENT:
+                if len(touched) > 0 and not self.swept:
+                    self.events.update(np.unique(np.concatenate(touched)))
+            else:
+                # Кандидаты в столкновения берутся из соседних клеток сетки, а не из всего массива
+                first, second = get_cell_pairs(self.entities, self.get_cell_size(), self.max_width, self.max_height, max_dist=2 * self.radius, periodic=self.periodic)
+                # Пары разрешаются партиями без общих частиц, каждая партия - одной операцией NumPy
+                self.kernels.resolve_pairs(self.entities, first, second, self.max_width, self.max_height, self.periodic)
+        return self.end_step(dt, forced)
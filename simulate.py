@@ -0,0 +1,93 @@
+import argparse
+import csv
+import math
+import sys
+import time
+import numpy as np
+from particles import ParticleSystem, Engine, Integrator, DipoleState
+from kernels import BACKENDS
+
+DEFAULT_DT = 0.0001
+
+
+def get_parser():
+    # Параметры те же, что у ползунков демонстрации, значения по умолчанию - их начальные положения
+    parser = argparse.ArgumentParser(description="Run the dipole simulation without a window and write the results to disk")
+    parser.add_argument('--count', type=int, default=200, help="number of gas particles")
+    parser.add_argument('--speed', type=float, default=40000, help="average speed of the gas particles")
+    parser.add_argument('--mass', type=float, default=10, help="mass of a gas particle")
+    parser.add_argument('--radius', type=float, default=3, help="radius of a gas particle")
+    parser.add_argument('--width', type=float, default=700, help="box width")
+    parser.add_argument('--height', type=float, default=500, help="box height")
+    parser.add_argument('--charge-radius', type=float, default=5, help="radius of a dipole charge")
+    parser.add_argument('--distance', type=float, default=186, help="distance between the charges of a dipole")
+    parser.add_argument('--charge', type=float, default=1, help="charge value")
+    parser.add_argument('--charge-mass', type=float, default=1, help="mass of a charge")
+    parser.add_argument('--dipoles', type=int, default=2, help="number of dipoles")
+    parser.add_argument('--engine', choices=[item.name.lower() for item in Engine], default='step')
+    parser.add_argument('--integrator', choices=[item.name.lower() for item in Integrator], default='rk4')
+    parser.add_argument('--backend', choices=list(BACKENDS), default='numpy')
+    parser.add_argument('--dt', type=float, default=DEFAULT_DT, help="time step")
+    length = parser.add_mutually_exclusive_group()
+    length.add_argument('--steps', type=int, help="number of steps (1000 by default)")
+    length.add_argument('--duration', type=float, help="simulated time")
+    parser.add_argument('--autotune', action='store_true', help="pick dt, collision cell size and backend from a calibration run")
+    parser.add_argument('--seed', type=int, help="random seed")
+    parser.add_argument('--every', type=int, default=1, help="write energies every N steps")
+    parser.add_argument('--output', default='energies.csv', help="CSV file with the energies over time")
+    parser.add_argument('--state', help="NPZ file with the final state of the gas and the dipoles")
+    return parser
+
+
+def get_parameters(args):
+    return dict(count=args.count, radius=args.radius, max_width=args.width, max_height=args.height, avg_vel=args.speed,
+                d_radius=args.charge_radius, r=args.distance / 2, charge=args.charge, charge_mass=args.charge_mass, m=args.mass,
+                n_dipoles=args.dipoles, engine=Engine[args.engine.upper()], integrator=Integrator[args.integrator.upper()],
+                backend=args.backend)
+
+
+def save_state(path, system, moment):
+    # Газ - в порядке исходных номеров молекул
+    order = np.argsort(system.ids)
+    np.savez(path, time=moment, entities=system.entities[order], ids=system.ids[order], state=system.state,
+             d_state=system.d_state, bonds=system.bonds)
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    if args.seed is not None:
+        np.random.seed(args.seed)
+    parameters = get_parameters(args)
+    dt = args.dt
+    tuning = None
+    if args.autotune:
+        from autotune import autotune
+        tuning = autotune(parameters, seed=args.seed or 0)
+        dt = tuning.dt
+        print(f"Auto-tuned: dt = {dt}, cell size = {tuning.cell_size}, backend = {tuning.backend}", file=sys.stderr)
+    system = ParticleSystem(**parameters)
+    if tuning is not None:
+        tuning.apply(system)
+    if args.duration is not None:
+        steps = max(math.ceil(args.duration / dt), 1)
+    else:
+        steps = args.steps if args.steps is not None else 1000
+
+    n = system.n_dipoles
+    start = time.perf_counter()
+    with open(args.output, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['time'] + [f'kinetic_{k}' for k in range(n)] + ['potential', 'full', 'stuck'])
+        for step in range(1, steps + 1):
+            res = system.proceed(dt)
+            if step % args.every == 0 or step == steps:
+                stuck = np.count_nonzero(system.d_state == DipoleState.STUCK.value)
+                writer.writerow([step * dt] + [float(value) for value in res] + [stuck])
+    elapsed = time.perf_counter() - start
+    if args.state:
+        save_state(args.state, system, steps * dt)
+    print(f"{steps} steps in {elapsed:.2f} s ({steps / max(elapsed, 1e-9):.1f} steps/s)", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from particles import ParticleSystem, Engine, Integrator
+from kernels import NumpyKernels, NumbaKernels
+
+# Ядра Numba должны повторять эталонные ядра NumPy: одинаковые системы с одним зерном
+# генератора после нескольких шагов должны совпадать с точностью до округления
+pytest.importorskip("numba")
+
+STEPS = 20
+DT = 0.0001
+PARAMETERS = dict(count=300, radius=3.0, max_width=400, max_height=300, avg_vel=2000.0, d_radius=5.0, r=40.0,
+                  charge=0.3, charge_mass=1.0, m=10.0)
+SETUPS = {
+    'rk4': dict(),
+    'verlet': dict(integrator=Integrator.VERLET),
+    'periodic': dict(periodic=True),
+    'swept': dict(swept=True, integrator=Integrator.VERLET),
+    'event': dict(engine=Engine.EVENT),
+    'float32': dict(dtype=np.float32),
+}
+
+
+def run(backend, setup, seed=3):
+    np.random.seed(seed)
+    system = ParticleSystem(**PARAMETERS, **SETUPS[setup], backend=backend)
+    for _ in range(STEPS):
+        energies = system.proceed(DT)
+    return system, np.array(energies)
+
+
+@pytest.mark.parametrize('setup', list(SETUPS))
+def test_backends_match(setup):
+    reference, expected = run('numpy', setup)
+    system, energies = run('numba', setup)
+    # Удары молекул друг о друга в float32 округляются в разном порядке
+    tolerance = dict(rtol=1e-5, atol=1e-2) if setup == 'float32' else dict(rtol=1e-9, atol=1e-9)
+    assert system.kernels.name == 'numba'
+    np.testing.assert_array_equal(np.sort(system.ids), np.sort(reference.ids))
+    np.testing.assert_allclose(system.entities[np.argsort(system.ids)], reference.entities[np.argsort(reference.ids)], **tolerance)
+    np.testing.assert_allclose(system.state, reference.state, **tolerance)
+    np.testing.assert_allclose(energies, expected, rtol=tolerance['rtol'])
+
+
+@pytest.mark.parametrize('periodic', [False, True])
+@pytest.mark.parametrize('reach', [0.05, 8.0, 190.0])
+def test_contacts_match(periodic, reach):
+    # Точки и за стенками ящика, и на самих стенках
+    random = np.random.RandomState(1)
+    entities = random.rand(3000, 4) * [400, 300, 1, 1]
+    entities[:4, 0:2] = [[0, 0], [400, 300], [0, 300], [400, 0]]
+    points = random.rand(300, 2) * [440, 340] - 20
+    points[:4] = entities[:4, 0:2]
+    expected = NumpyKernels().get_contacts(entities, points, reach, 400, 300, periodic)
+    result = NumbaKernels().get_contacts(entities, points, reach, 400, 300, periodic)
+    np.testing.assert_array_equal(result[0], expected[0])
+    np.testing.assert_array_equal(result[1], expected[1])